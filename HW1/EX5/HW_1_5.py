@@ -1,17 +1,117 @@
 import os
 import datetime
+import fnmatch
+import hashlib
+import json
+import math
+import mmap
 import random
 import re
+import time
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from itertools import chain, islice, repeat, zip_longest
 
+import numpy as np
 
+# The functions HW_1_6.instrument times by default.
+HOT_FUNCTIONS = (
+    'scan_directory', 'random_dates_between', 'get_recipe_price', 'PriceTable.price_many', 'perfect_numbers',
+    'extract_messages', 'modify_chapter_name_and_copy_files',
+)
 
-def get_files_in_directory(path):
-    file_names = []
+
+def get_files_in_directory(path, prefix="deep"):
+    return [os.path.basename(file_path) for file_path in scan_directory(path, prefix=prefix)]
+
+
+def _list_directory(path, cache=None):
+    """List the file and subdirectory names of a directory.
+
+    The types come from the DirEntry objects, which usually know them without a stat call.
+    With a cache, a directory whose mtime didn't change since it was cached isn't listed again.
+    """
+    if cache is not None:
+        mtime = os.stat(path).st_mtime_ns  # Taken first, so a change during the listing is noticed next time.
+        cached = cache.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1], cached[2]
+    files, directories = [], []
     with os.scandir(path) as directory:
         for entry in directory:
-            if entry.is_file() and entry.name.startswith("deep"):
-                file_names.append(os.path.basename(entry.path))
-    return file_names
+            if entry.is_file():
+                files.append(entry.name)
+            elif entry.is_dir(follow_symlinks=False):
+                directories.append(entry.name)
+    if cache is not None:
+        cache[path] = [mtime, files, directories]
+    return files, directories
+
+
+def scan_directory(path, prefix=None, glob=None, regex=None, recursive=False, workers=None, cache_path=None):
+    """Generate the paths of the files in a directory that pass every given filter.
+
+    :param str path: The directory to scan.
+    :param str prefix: Optional, keep names starting with this.
+    :param str glob: Optional, keep names matching this shell pattern.
+    :param regex: Optional, keep names in which this regular expression is found.
+    :param bool recursive: Whether to go into subdirectories (symlinked ones are skipped).
+    :param int workers: Optional, list this many directories at once in a thread pool, which pays off on
+        network filesystems. The order of the results is then not fixed.
+    :param str cache_path: Optional, a JSON file caching the listings of directories, which are only listed
+        again once their mtime changes.
+    """
+    regex = re.compile(regex) if isinstance(regex, str) else regex
+
+    def matches(name):
+        return ((prefix is None or name.startswith(prefix))
+                and (glob is None or fnmatch.fnmatch(name, glob))
+                and (regex is None or regex.search(name)))
+
+    cache = None
+    if cache_path is not None:
+        cache = {}
+        if os.path.exists(cache_path):
+            with open(cache_path) as cache_file:
+                cache = json.load(cache_file)
+    try:
+        if workers:
+            listings = _list_directories_in_pool(path, recursive, workers, cache)
+        else:
+            listings = _list_directories(path, recursive, cache)
+        for directory, files in listings:
+            for name in files:
+                if matches(name):
+                    yield os.path.join(directory, name)
+    finally:
+        if cache is not None:
+            with open(cache_path, 'w') as cache_file:
+                json.dump(cache, cache_file)
+
+
+def _list_directories(path, recursive, cache):
+    pending = [path]
+    while pending:
+        directory = pending.pop()
+        files, directories = _list_directory(directory, cache)
+        yield directory, files
+        if recursive:
+            pending.extend(os.path.join(directory, name) for name in reversed(directories))
+
+
+def _list_directories_in_pool(path, recursive, workers, cache):
+    with ThreadPoolExecutor(workers) as executor:
+        pending = {executor.submit(_list_directory, path, cache): path}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                directory = pending.pop(future)
+                files, directories = future.result()
+                yield directory, files
+                if recursive:
+                    for name in directories:
+                        subdirectory = os.path.join(directory, name)
+                        pending[executor.submit(_list_directory, subdirectory, cache)] = subdirectory
 
 
 def random_date_between_dates(start_date, end_date):
@@ -21,6 +121,36 @@ def random_date_between_dates(start_date, end_date):
     return (start + datetime.timedelta(days=random.randint(0, delta.days))).strftime("%A, %B %d, %Y")
 
 
+def random_dates_between(start_date, end_date, n, seed=None, as_strings=True):
+    """Draw n random dates between two dates, both included, at once.
+
+    The dates are parsed once, the day offsets are drawn with NumPy, and each
+    distinct day is formatted only once.
+
+    :param str start_date: The first possible date, as YYYY-MM-DD.
+    :param str end_date: The last possible date, as YYYY-MM-DD.
+    :param int n: How many dates to draw.
+    :param seed: Optional, a seed that makes the draw reproducible.
+    :param bool as_strings: Whether to return the dates formatted like random_date_between_dates does,
+        or as a datetime64[D] array.
+    :return: The dates.
+    :rtype: list[str] or numpy.ndarray
+    """
+    first_day = datetime.datetime.strptime(start_date, '%Y-%m-%d').date()
+    last_day = datetime.datetime.strptime(end_date, '%Y-%m-%d').date()
+    start = np.datetime64(first_day, 'D')
+    num_days = (last_day - first_day).days + 1
+    if num_days < 1:
+        raise ValueError("end_date is before start_date")
+    offsets = np.random.default_rng(seed).integers(0, num_days, n)
+    if not as_strings:
+        return start + offsets
+    days, day_indexes = np.unique(offsets, return_inverse=True)
+    formatted = np.array([(first_day + datetime.timedelta(days=day)).strftime("%A, %B %d, %Y")
+                          for day in days.tolist()], dtype=object)
+    return formatted[day_indexes].tolist()
+
+
 def join(*args, sep='-'):
     result = []
     for i, lst in enumerate(args):
@@ -30,6 +160,14 @@ def join(*args, sep='-'):
     return result
 
 
+def ijoin(*args, sep='-'):
+    """Like join, but lazily: returns an iterator over the items, never a list."""
+    if not sep:
+        return chain.from_iterable(args)
+    # (sep,), args[0], (sep,), args[1], ... with the leading separator dropped.
+    return chain.from_iterable(islice(chain.from_iterable(zip(repeat((sep,)), args)), 1, None))
+
+
 def get_recipe_price(prices, optionals=None, **ingredients):
     total_price = 0
     for ingredient, amount in ingredients.items():
@@ -43,8 +181,59 @@ def get_recipe_price(prices, optionals=None, **ingredients):
     return round(total_price, 2)
 
 
-def perfect_numbers():
-    """Generate all perfect numbers."""
+class PriceTable:
+    """A price list compiled once, to price many recipes against it.
+
+    Each ingredient gets a column number and its price per gram goes in a NumPy
+    vector, so a batch of recipes is priced as one sparse matrix-vector product.
+    The prices are the same as get_recipe_price's, to the last digit.
+
+    :param dict prices: The price of 100 grams of each ingredient.
+    """
+
+    def __init__(self, prices):
+        self.columns = {ingredient: column for column, ingredient in enumerate(prices)}
+        self.prices = np.array([price_per_100g / 100 for price_per_100g in prices.values()], dtype=float)
+
+    def price(self, optionals=None, **ingredients):
+        """Price one recipe, like get_recipe_price."""
+        return self.price_many([ingredients], optionals)[0]
+
+    def price_many(self, recipes, optionals=None):
+        """Price a batch of recipes.
+
+        :param recipes: The grams of each ingredient in each recipe.
+        :type recipes: iterable[dict]
+        :param optionals: Optional, ingredients that are left out of every price.
+        :return: The price of each recipe, rounded to 2 digits.
+        :rtype: list[float]
+        :raises ValueError: if a recipe has an ingredient that isn't in the price list.
+        """
+        recipes = list(recipes)
+        rows, columns, amounts = [], [], []
+        get_column = self.columns.get
+        for row, recipe in enumerate(recipes):
+            rows.extend([row] * len(recipe))
+            columns.extend(map(get_column, recipe))
+            amounts.extend(recipe.values())
+        for ingredient in chain.from_iterable(recipes) if None in columns else ():
+            if ingredient not in self.columns:
+                raise ValueError(f"{ingredient} is not a valid ingredient.")
+        rows = np.array(rows, dtype=np.intp)
+        columns = np.array(columns, dtype=np.intp)
+        amounts = np.array(amounts, dtype=float)
+        if optionals:
+            kept = np.ones(len(self.prices), dtype=bool)
+            kept[[self.columns[ingredient] for ingredient in optionals if ingredient in self.columns]] = False
+            kept = kept[columns]
+            rows, columns, amounts = rows[kept], columns[kept], amounts[kept]
+        # bincount adds up each row's terms in order, so the sums are the same floats as get_recipe_price's.
+        totals = np.bincount(rows, weights=self.prices[columns] * amounts, minlength=len(recipes))
+        return [round(total, 2) for total in totals.tolist()]
+
+
+def perfect_numbers_by_division():
+    """Generate all perfect numbers by summing the divisors of every number. Slow, O(n^2)."""
     n = 1
     while True:
         divisors = [i for i in range(1, n) if n % i == 0]
@@ -53,67 +242,340 @@ def perfect_numbers():
         n += 1
 
 
-def extract_messages(filename):  # TODO  fix it.
-    """Extract hidden messages from a binary file."""
-    msg_buffer = ''
-    with open('resources/logo.jpg', 'rb') as f:
-        while True:
-            chunk = f.read(1024)  # Read 1 KB at a time
-            if not chunk:  # End of file
-                break
-            for char in chunk:
-                if char in range(97, 123):  # Check if char is lowercase
-                    msg_buffer += chr(char)
-                    if msg_buffer[-1] == '!':  # Found a complete message
-                        yield msg_buffer[:-1]  # Yield the message without the '!'
-                        msg_buffer = ''
-                else:
-                    msg_buffer = ''  # Reset buffer if non-message char is found
-
-
-def combine_iterables(*iterables):
-    """Combine two or more iterables into tuples."""
-    iters = [iter(it) for it in iterables]
-    while True:
+def is_mersenne_prime(p):
+    """Lucas-Lehmer test: whether 2^p - 1 is prime, for a prime p."""
+    if p == 2:
+        return True
+    mersenne = (1 << p) - 1
+    s = 4
+    for _ in range(p - 2):
+        s = s * s - 2
+        # s mod 2^p - 1 without a division: 2^p is 1 modulo 2^p - 1.
+        s = (s & mersenne) + (s >> p)
+        if s >= mersenne:
+            s -= mersenne
+    return s == 0
+
+
+def perfect_numbers_sieve(limit):
+    """Find the perfect numbers up to limit with a divisor-sum sieve.
+
+    Every divisor d <= sqrt(limit) is added, together with its co-divisor, to all
+    its multiples in one NumPy operation. Takes O(limit) memory.
+    """
+    if limit < 6:
+        return []
+    divisor_sums = np.ones(limit + 1, dtype=np.int64)  # 1 divides everything...
+    divisor_sums[1] = 0  # ...but isn't a proper divisor of 1, and 0 is no perfect number.
+    for d in range(2, math.isqrt(limit) + 1):
+        multiples = divisor_sums[d * d::d]
+        multiples += d + np.arange(d, d + len(multiples), dtype=np.int64)
+        multiples[0] -= d  # d * d has d as a divisor only once
+    return np.flatnonzero(divisor_sums == np.arange(limit + 1)).tolist()
+
+
+def perfect_numbers(limit=None, count=None, method='euclid'):
+    """Generate all perfect numbers, in increasing order.
+
+    The 'euclid' method uses the Euclid-Euler theorem: the even perfect numbers are
+    2^(p-1) * (2^p - 1) for the Mersenne primes 2^p - 1, found with the Lucas-Lehmer
+    test. No odd perfect number is known (there is none below 10^1500), so this is
+    the same sequence as checking every number. The 'sieve' method checks every
+    number up to limit with perfect_numbers_sieve, and needs a limit.
+
+    :param int limit: Optional, stop at numbers larger than this.
+    :param int count: Optional, stop after this many numbers.
+    :param str method: 'euclid' or 'sieve'.
+    """
+    if method == 'sieve':
+        if limit is None:
+            raise ValueError("The sieve method needs a limit")
+        yield from perfect_numbers_sieve(limit)[:count]
+        return
+    if method != 'euclid':
+        raise ValueError(f"{method} is not a valid method.")
+    found = 0
+    p = 1
+    while count is None or found < count:
+        p += 1
+        if not all(p % i for i in range(2, math.isqrt(p) + 1)) or not is_mersenne_prime(p):
+            continue
+        n = (1 << (p - 1)) * ((1 << p) - 1)
+        if limit is not None and n > limit:
+            return
+        yield n
+        found += 1
+
+
+def extract_messages(filename, min_length=1, block_size=1 << 22):
+    """Extract hidden messages from a binary file.
+
+    A message is a run of lowercase letters followed by a '!', which is not part
+    of the message. The file is memory mapped and scanned a block at a time with
+    NumPy masks, and messages are generated as they are found. Files that can't
+    be mapped, such as pipes, are read a block at a time instead.
+
+    :param str filename: The file to search.
+    :param int min_length: The length of the shortest message.
+    :param int block_size: How many bytes to scan at a time.
+    """
+    with open(filename, 'rb') as file:
         try:
-            items = tuple(next(it) for it in iters)
-            yield items
-        except StopIteration:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files and pipes can't be mapped.
+            yield from _scan_for_messages(iter(lambda: file.read(block_size), b''), min_length)
             return
+        try:
+            with memoryview(data) as view:
+                blocks = (view[start:start + block_size] for start in range(0, len(view), block_size))
+                yield from _scan_for_messages(blocks, min_length)
+        finally:
+            data.close()
 
 
-def modify_chapter_name_and_copy_files(folder_path, new_folder_path):
+def _scan_for_messages(blocks, min_length):
+    """Find the messages in consecutive blocks of bytes, including those split between blocks."""
+    carry = b''  # The letters at the end of the previous block.
+    for block in blocks:
+        data = np.frombuffer(block, dtype=np.uint8)
+        is_letter = (data >= ord('a')) & (data <= ord('z'))
+        run_starts = np.flatnonzero(is_letter & ~np.concatenate(([False], is_letter[:-1])))
+        if carry and len(data) and data[0] == ord('!') and len(carry) >= min_length:
+            yield carry.decode('ascii')
+        ends = np.flatnonzero(data == ord('!'))
+        # Only a '!' right after a letter ends a message; its run of letters starts at the last run start before it.
+        ends = ends[ends > 0]
+        ends = ends[is_letter[ends - 1]]
+        starts = run_starts[np.searchsorted(run_starts, ends, 'right') - 1]
+        # Only a message starting at the block's start can go on from the carry.
+        lengths = ends - starts + np.where(starts == 0, len(carry), 0)
+        keep = lengths >= min_length
+        for start, end in zip(starts[keep].tolist(), ends[keep].tolist()):
+            message = bytes(block[start:end])
+            if start == 0:
+                message = carry + message
+            yield message.decode('ascii')
+        if len(data) and is_letter[-1]:
+            start = int(run_starts[-1])
+            carry = (carry if start == 0 else b'') + bytes(block[start:])
+        else:
+            carry = b''
+        del data, is_letter  # Let go of the block before the file is unmapped.
+
+
+def combine_iterables(*iterables, strict=False, longest=False, fillvalue=None):
+    """Combine two or more iterables into tuples.
+
+    Stops at the shortest iterable, like zip. With strict, raises ValueError if the
+    iterables aren't all the same length; with longest, runs to the end of the
+    longest one and pads the others with fillvalue.
+    """
+    if strict and longest:
+        raise ValueError("strict and longest can't be used together.")
+    if longest:
+        return zip_longest(*iterables, fillvalue=fillvalue)
+    return zip(*iterables, strict=strict)
+
+
+_CHAPTER_OPTION = re.compile(r'<option value="([^"]*)">(Chapter \1:[^<]+)</option>')
+_CHAPTER_TITLE = re.compile(r'id="chapter-title">Chapter (\d+): ([^<]+)<')
+
+ChapterReport = namedtuple('ChapterReport', 'filename status chapter_name')
+
+
+def _read_chapter_head(file, head_size):
+    """Read about head_size characters, up to the end of a line, so no tag is cut in half."""
+    head = file.read(head_size)
+    if len(head) == head_size:
+        head += file.readline()
+    return head
+
+
+def _find_chapter_option(text, chapter_number):
+    for match in _CHAPTER_OPTION.finditer(text):
+        if match.group(1) == chapter_number:
+            return match.group(2)
+    return None
+
+
+def _rewrite_chapter(source_path, target_path, head_size):
+    """Copy a chapter file, renaming its chapter after its option in the chapters menu.
+
+    Only the head of the file is searched for the chapter title and its option, unless it
+    doesn't hold both, in which case the whole file is. Every chapter title in the file is
+    renamed, streaming the rest of the file after the head.
+    """
+    filename = os.path.basename(source_path)
+    chapter_number = filename.split('.')[0]
+    with open(source_path, 'r') as file:
+        head = _read_chapter_head(file, head_size)
+        chapter_title = _find_chapter_option(head, chapter_number)
+        if chapter_title is None or not _CHAPTER_TITLE.search(head):
+            head += file.read()
+            chapter_title = _find_chapter_option(head, chapter_number)
+        if not _CHAPTER_TITLE.search(head):
+            return ChapterReport(filename, 'no chapter name', None)
+        if chapter_title is None:
+            chapter_title = "Chapter not found"
+
+        new_chapter_name = f"{chapter_number}: {chapter_title}"
+
+        def rename(text):
+            return _CHAPTER_TITLE.sub(lambda match: f'id="chapter-title">{new_chapter_name}<', text)
+
+        with open(target_path, 'w') as new_file:
+            # A chapter title holds no '<' but the one ending it, so the text can be renamed
+            # piece by piece, cutting each piece right after a '<'.
+            pending = head
+            while chunk := file.read(1 << 16):
+                pending += chunk
+                cut = pending.rfind('<') + 1
+                new_file.write(rename(pending[:cut]))
+                pending = pending[cut:]
+            new_file.write(rename(pending))
+    return ChapterReport(filename, 'renamed', new_chapter_name)
+
+
+def _chapter_fingerprint(path, use_hash):
+    if use_hash:
+        with open(path, 'rb') as file:
+            return hashlib.file_digest(file, 'sha256').hexdigest()
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def modify_chapter_name_and_copy_files(folder_path, new_folder_path, workers=None, incremental=False,
+                                       use_hash=False, head_size=1 << 16):
+    """Copy the chapter files of a folder, naming each chapter after its option in the chapters menu.
+
+    :param str folder_path: The folder with the .html chapter files.
+    :param str new_folder_path: The folder to write the renamed chapters to. Created if it doesn't exist.
+    :param int workers: Optional, rewrite files in a pool of this many processes.
+    :param bool incremental: Skip the files that didn't change since the last run, going by a manifest
+        kept in new_folder_path.
+    :param bool use_hash: Tell changed files by a hash of their contents instead of their mtime and size.
+    :param int head_size: How much of the top of each file to search for the chapter title.
+    :return: What happened to each file: 'renamed', 'no chapter name' or 'unchanged'.
+    :rtype: list[ChapterReport]
+    """
     # Create the new directory if it doesn't exist
     if not os.path.exists(new_folder_path):
         os.makedirs(new_folder_path)
 
+    manifest_path = os.path.join(new_folder_path, '.chapters-manifest.json')
+    manifest = {}
+    if incremental and os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+
+    reports = {}
+    new_manifest = {}
+    to_rewrite = []
     for filename in os.listdir(folder_path):
-        if filename.endswith('.html'):
-            with open(os.path.join(folder_path, filename), 'r') as file:
-                contents = file.read()
-                chapter_number = filename.split('.')[0]
-                chapter_title = re.search(
-                    fr'<option value="{chapter_number}">(Chapter {chapter_number}:[^<]+)</option>',
-                    contents)
-
-                if chapter_title:
-                    chapter_title = chapter_title.group(1)
-                else:
-                    chapter_title = "Chapter not found"
-                chapter_name = re.search(r'id="chapter-title">Chapter (\d+): ([^<]+)<', contents).group(2)
-
-                if chapter_name:
-                    new_chapter_name = f"{filename.split('.')[0]}: {chapter_title}"
-                    new_contents = re.sub(r'id="chapter-title">Chapter (\d+): ([^<]+)<',
-                                          f'id="chapter-title">{new_chapter_name}<', contents)
-                    # Replace the old chapter name with the new chapter name
-
-                    new_filename = f"{filename.split('.')[0]}.html"
-                    new_file_path = os.path.join(new_folder_path, new_filename)
-                    with open(new_file_path, 'w') as new_file:
-                        new_file.write(new_contents)  # Write the modified contents to the new file
-                    print(f"{filename} ->  new chapter is :  {new_chapter_name}")
-                else:
-                    print(f"{filename}: Chapter name not found")
+        if not filename.endswith('.html'):
+            continue
+        source_path = os.path.join(folder_path, filename)
+        target_path = os.path.join(new_folder_path, filename)
+        if incremental:
+            fingerprint = _chapter_fingerprint(source_path, use_hash)
+            previous = manifest.get(filename)
+            if previous and previous['fingerprint'] == fingerprint and \
+                    (previous['status'] != 'renamed' or os.path.exists(target_path)):
+                reports[filename] = ChapterReport(filename, 'unchanged', previous['chapter_name'])
+                new_manifest[filename] = previous
+                continue
+            new_manifest[filename] = {'fingerprint': fingerprint}
+        reports[filename] = None
+        to_rewrite.append((source_path, target_path, head_size))
+
+    if workers:
+        with ProcessPoolExecutor(workers) as executor:
+            rewritten = list(executor.map(_rewrite_chapter, *zip(*to_rewrite), chunksize=64)) if to_rewrite else []
+    else:
+        rewritten = [_rewrite_chapter(*args) for args in to_rewrite]
+    for report in rewritten:
+        reports[report.filename] = report
+        if incremental:
+            new_manifest[report.filename].update(status=report.status, chapter_name=report.chapter_name)
+
+    if incremental:
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump(new_manifest, manifest_file)
+    return list(reports.values())
+
+
+def compare_perfect_numbers(k=4):
+    """Time how long each way of finding perfect numbers takes to find the first k of them."""
+    start_time = time.perf_counter()
+    expected = list(islice(perfect_numbers_by_division(), k))
+    print(f"division: {time.perf_counter() - start_time:.4f}s")
+
+    start_time = time.perf_counter()
+    assert perfect_numbers_sieve(expected[-1]) == expected
+    print(f"sieve: {time.perf_counter() - start_time:.4f}s")
+
+    start_time = time.perf_counter()
+    assert list(perfect_numbers(count=k)) == expected
+    print(f"euclid: {time.perf_counter() - start_time:.4f}s")
+
+
+def compare_random_dates(n=1_000_000, start_date='2000-01-01', end_date='2030-12-31'):
+    """Compare drawing n random dates one call at a time and in one batch."""
+    start_time = time.perf_counter()
+    for _ in range(n):
+        random_date_between_dates(start_date, end_date)
+    print(f"random_date_between_dates loop: {time.perf_counter() - start_time:.4f}s")
+
+    start_time = time.perf_counter()
+    random_dates_between(start_date, end_date, n)
+    print(f"random_dates_between: {time.perf_counter() - start_time:.4f}s")
+
+
+def compare_join(num_lists=1_000, list_length=1_000):
+    """Compare join with consuming ijoin."""
+    lists = [range(list_length)] * num_lists
+
+    start_time = time.perf_counter()
+    join(*lists)
+    print(f"join: {time.perf_counter() - start_time:.4f}s")
+
+    start_time = time.perf_counter()
+    deque(ijoin(*lists), maxlen=0)
+    print(f"ijoin: {time.perf_counter() - start_time:.4f}s")
+
+
+def compare_combine_iterables(n=1_000_000, width=3):
+    """Compare the old next()-per-item combine_iterables loop with the zip-based one."""
+    def combine_with_next(*iterables):
+        iters = [iter(it) for it in iterables]
+        while True:
+            items = []
+            for it in iters:
+                try:
+                    items.append(next(it))
+                except StopIteration:
+                    return
+            yield tuple(items)
+
+    iterables = [range(n)] * width
+    for name, combine in [("next() loop", combine_with_next), ("zip", combine_iterables)]:
+        start_time = time.perf_counter()
+        deque(combine(*iterables), maxlen=0)
+        print(f"{name}: {time.perf_counter() - start_time:.4f}s")
+
+
+def compare_recipe_prices(num_recipes=10_000, num_ingredients=500):
+    """Compare pricing a menu with get_recipe_price calls and with one PriceTable.price_many call."""
+    rng = random.Random(0)
+    prices = {f'ingredient{i}': rng.randint(1, 100) for i in range(num_ingredients)}
+    recipes = [{ingredient: rng.randint(1, 500) for ingredient in rng.sample(list(prices), 8)}
+               for _ in range(num_recipes)]
 
+    start_time = time.perf_counter()
+    expected = [get_recipe_price(prices, **recipe) for recipe in recipes]
+    print(f"get_recipe_price loop: {time.perf_counter() - start_time:.4f}s")
 
+    start_time = time.perf_counter()
+    assert PriceTable(prices).price_many(recipes) == expected
+    print(f"PriceTable.price_many: {time.perf_counter() - start_time:.4f}s")
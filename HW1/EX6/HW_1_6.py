@@ -1,91 +1,310 @@
+import io
+import inspect
+import json
+import marshal
+import math
+import mmap
+import operator
+import re
+import statistics
 import time
+import tracemalloc
 import os
+from collections import Counter, defaultdict, deque
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+from functools import partial, reduce, wraps
+from hashlib import blake2b
+from heapq import heappush, heapreplace, nlargest
+from itertools import count, islice
+from operator import and_, itemgetter
+
 import numpy as np
 from PIL import Image
 
 
+# The functions instrument times by default.
+HOT_FUNCTIONS = (
+    'read_words_list', 'read_words_set', 'iter_words', 'iter_words_mmap', 'find_states_same_row',
+    'word_frequency', 'word_frequency_file', 'group_by', 'find_black_pixels', 'encrypt_sentence',
+)
+
+
+WORD_LOADERS = {}
+
+
+def register_word_loader(func):
+    """Add a loader to the ones compare_read_words benchmarks."""
+    WORD_LOADERS[func.__name__] = func
+    return func
+
+
+@register_word_loader
 def read_words_list(filename):
     with open(filename, 'r') as file:
         words = file.read().split()
     return words
 
 
+@register_word_loader
 def read_words_set(filename):
     with open(filename, 'r') as file:
         words = set(file.read().split())
     return words
 
 
-def compare_read_words(filename):
-    list_start_time = time.time()
-    words_list = read_words_list(filename)
-    list_end_time = time.time()
-    list_elapsed_time = list_end_time - list_start_time
-
-    set_start_time = time.time()
-    words_set = read_words_set(filename)
-    set_end_time = time.time()
-    set_elapsed_time = set_end_time - set_start_time
-
-    if list_elapsed_time < set_elapsed_time:
-        print("List is faster")
-        print("list: ", list_elapsed_time)
-        print("set: ", set_elapsed_time)
-    elif list_elapsed_time > set_elapsed_time:
-        print("Set is faster")
-        print("list: ", list_elapsed_time)
-        print("set: ", set_elapsed_time)
-    else:
-        print("Both are equally fast")
-        print("list: ", list_elapsed_time)
-        print("set: ", set_elapsed_time)
+@register_word_loader
+def iter_words(filename, chunk_size=1 << 16):
+    """Yield the words of a file, reading chunk_size characters at a time."""
+    with open(filename, 'r') as file:
+        carry = ''
+        while chunk := file.read(chunk_size):
+            words = (carry + chunk).split()
+            # A word at the end of the chunk may continue in the next one.
+            carry = words.pop() if words and not chunk[-1].isspace() else ''
+            yield from words
+        if carry:
+            yield carry
 
-    return
 
+_WHITESPACE = re.compile(rb'\s')
 
-def find_states_same_row(filename):
-    with open(filename, 'r') as file:
-        states = file.read().split()
 
-    rows = ['qwertyuiop', 'asdfghjkl', 'zxcvbnm']
-    same_row_states = []
+def _word_spans(mm, chunk_size):
+    start = 0
+    while start < len(mm):
+        match = _WHITESPACE.search(mm, start + chunk_size)
+        end = match.start() if match else len(mm)
+        yield start, end
+        start = end
+
+
+@register_word_loader
+def iter_words_mmap(filename, chunk_size=1 << 20, encoding='utf-8'):
+    """Yield the words of a memory-mapped file, decoding chunk_size bytes at a time.
+
+    Chunks are cut at ASCII whitespace, which never falls inside a multi-byte character.
+    """
+    with open(filename, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for start, end in _word_spans(mm, chunk_size):
+                yield from mm[start:end].decode(encoding).split()
+
+
+@register_word_loader
+def read_words_set_streaming(filename, chunk_size=1 << 16):
+    """Like read_words_set, but only ever holds one chunk of the file and the distinct words."""
+    return set(iter_words(filename, chunk_size))
+
+
+def benchmark(funcs, *args, warmup=1, repeats=5, trace_memory=True, json_path=None):
+    """Time each function on the same arguments and report the median and 95th percentile.
+
+    Iterators that a function returns are consumed as part of its run. Peak memory is
+    measured with tracemalloc in one extra run, so it doesn't slow down the timed ones.
+
+    :param dict funcs: The functions to compare, by name.
+    :param int warmup: Untimed runs before the timed ones.
+    :param int repeats: Timed runs.
+    :param bool trace_memory: Whether to measure peak memory.
+    :param json_path: Optional, a file to also write the results to as JSON.
+    :return: The median and p95 seconds and the peak bytes of each function, by name.
+    :rtype: dict
+    """
+    def run(func):
+        result = func(*args)
+        if iter(result) is result:
+            deque(result, maxlen=0)
+
+    results = {}
+    for name, func in funcs.items():
+        for _ in range(warmup):
+            run(func)
+        times = []
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            run(func)
+            times.append(time.perf_counter() - start_time)
+        times.sort()
+        peak_memory = None
+        if trace_memory:
+            tracemalloc.start()
+            try:
+                run(func)
+                peak_memory = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+        results[name] = {
+            'median': statistics.median(times),
+            'p95': times[math.ceil(0.95 * len(times)) - 1],
+            'peak_memory': peak_memory,
+        }
+        memory = '' if peak_memory is None else f"  peak {peak_memory / 2 ** 20:.1f} MiB"
+        print(f"{name}: median {results[name]['median']:.4f}s  p95 {results[name]['p95']:.4f}s{memory}")
+
+    if json_path is not None:
+        with open(json_path, 'w') as file:
+            json.dump({'repeats': repeats, 'warmup': warmup, 'results': results}, file, indent=2)
+    return results
+
 
-    for state in states:
-        row_found = False
-        for row in rows:
-            if all(char.lower() in row for char in state):
-                same_row_states.append(state)
-                row_found = True
-                break
-        if not row_found:
-            continue
+def compare_read_words(filename, repeats=5, json_path=None):
+    return benchmark(WORD_LOADERS, filename, repeats=repeats, json_path=json_path)
 
-    return same_row_states
+
+KEYBOARD_ROWS = ('qwertyuiop', 'asdfghjkl', 'zxcvbnm')
+
+
+class _RowMasks(dict):
+    """A str.translate table from each character to the bitmask of the rows it's on, as a character."""
+
+    def __missing__(self, code):
+        # Characters that aren't on the keyboard are on no row; remember them so the next lookup stays in C.
+        self[code] = '\0'
+        return '\0'
+
+
+def keyboard_row_masks(rows=KEYBOARD_ROWS):
+    masks = _RowMasks()
+    for bit, row in enumerate(rows):
+        for char in row:
+            for key in {char, char.upper()}:
+                if len(key) != 1:
+                    # Like 'ß'.upper() == 'SS': no single character of a word can be that key.
+                    continue
+                masks[ord(key)] = chr(ord(masks.get(ord(key), '\0')) | 1 << bit)
+    return masks
+
+
+def _same_row_words(words, masks):
+    # A word is typed on one row if the masks of its distinct characters still share a bit.
+    return [word for word in words if reduce(and_, map(ord, set(word.translate(masks))))]
+
+
+def iter_states_same_row(filename, rows=KEYBOARD_ROWS, workers=None, batch_size=10_000):
+    """Stream the words of a file that can be typed on a single keyboard row, in file order.
+
+    With workers, batches of batch_size words are classified in that many processes,
+    with at most two batches per worker in flight.
+    """
+    masks = keyboard_row_masks(rows)
+    words = iter_words(filename)
+    if not workers:
+        for word in words:
+            if reduce(and_, map(ord, set(word.translate(masks)))):
+                yield word
+        return
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()
+        while batch := list(islice(words, batch_size)):
+            pending.append(executor.submit(_same_row_words, batch, masks))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def find_states_same_row(filename, rows=KEYBOARD_ROWS, workers=None):
+    return list(iter_states_same_row(filename, rows, workers))
+
+
+_CALC_OPS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+}
+
+_INT64_MAX = 2 ** 63 - 1
+
+_CALC_UFUNCS = {
+    '+': np.add,
+    '-': np.subtract,
+    '*': np.multiply,
+    '/': np.true_divide,
+}
 
 
 def calc(op, a, b):
-    def add(a, b):
-        return a + b
+    func = _CALC_OPS.get(op)
+    if func is None:
+        return None
+    return func(a, b)
 
-    def subtract(a, b):
-        return a - b
 
-    def multiply(a, b):
-        return a * b
+def _largest_magnitude(array):
+    return max(abs(int(array.min())), abs(int(array.max()))) if array.size else 0
 
-    def divide(a, b):
-        return a / b
 
-    ops = {
-        '+': add,
-        '-': subtract,
-        '*': multiply,
-        '/': divide
-    }
+def _integer_operands(op, a_array, b_array):
+    """Integer or boolean operands as int64 if op can't overflow on them, as Python ints otherwise."""
+    a_max, b_max = _largest_magnitude(a_array), _largest_magnitude(b_array)
+    if op == '/':
+        # Up to 2**53 the integers are exact as floats, so dividing them rounds the way Python's int / int does.
+        fits = max(a_max, b_max) <= 2 ** 53
+    elif op == '*':
+        fits = a_max * b_max <= _INT64_MAX
+    else:
+        fits = a_max + b_max <= _INT64_MAX
+    dtype = np.int64 if fits else object
+    return a_array.astype(dtype), b_array.astype(dtype)
+
+
+def _operand_array(numbers):
+    array = np.asarray(numbers)
+    if array.dtype.kind == 'f' and not isinstance(numbers, np.ndarray):
+        # NumPy makes floats of ints next to a float, or next to an int too big for int64.
+        objects = np.array(numbers, dtype=object)
+        if not all(isinstance(number, float) for number in objects.flat):
+            return objects
+    return array
 
-    if op not in ops:
+
+def calc_many(op, a_array, b_array):
+    """Like calc, on whole arrays at once.
+
+    Dividing by zero raises ZeroDivisionError, as in calc, rather than giving inf or nan.
+    Integers and booleans are worked on as int64 only when no result can overflow it, and as
+    Python ints otherwise, so integer results are always the ones calc gives. Sequences that
+    mix ints and floats are worked on as Python numbers, which is slower but exact.
+    """
+    ufunc = _CALC_UFUNCS.get(op)
+    if ufunc is None:
         return None
-    return ops[op](a, b)
+    a_array, b_array = _operand_array(a_array), _operand_array(b_array)
+    if a_array.dtype.kind in 'biu' and b_array.dtype.kind in 'biu':
+        a_array, b_array = _integer_operands(op, a_array, b_array)
+    elif a_array.dtype == object or b_array.dtype == object:
+        # Keep big integers as Python ints on both sides, or mixing in an int64 turns them into floats.
+        a_array, b_array = a_array.astype(object), b_array.astype(object)
+    if op == '/' and np.any(b_array == 0):
+        raise ZeroDivisionError("division by zero")
+    return ufunc(a_array, b_array)
+
+
+def calc_expressions(expressions):
+    """Evaluate a list of (op, a, b) tuples, with one calc_many call per operator.
+
+    The results are the ones calc gives. A list mixing ints and floats is worked on as
+    Python numbers, so it is slower than one with only ints or only floats.
+
+    :return: The result of each expression in order, None for an unknown operator.
+    :rtype: list
+    """
+    if not expressions:
+        return []
+    ops = list(map(itemgetter(0), expressions))
+    op_array = np.array(ops)
+    a_array = _operand_array(list(map(itemgetter(1), expressions)))
+    b_array = _operand_array(list(map(itemgetter(2), expressions)))
+    results = np.full(len(expressions), None, dtype=object)
+    for op in set(ops) & _CALC_UFUNCS.keys():
+        selected = op_array == op
+        results[selected] = calc_many(op, a_array[selected], b_array[selected])
+    return results.tolist()
 
 
 def apply(func, iterable):
@@ -94,11 +313,7 @@ def apply(func, iterable):
 
 
 def my_filter(func, iterable):
-    filtered_list = []
-    for val in iterable:
-        if func(val):
-            filtered_list.append(val)
-    return filtered_list
+    return list(filter(func, iterable))
 
 
 def get_positive_numbers():
@@ -106,16 +321,214 @@ def get_positive_numbers():
     return [n for n in numbers if int(n) > 0]
 
 
-def timer(func, *args):
-    start_time = time.time()
-    result = func(*args)
-    end_time = time.time()
-    duration = end_time - start_time
-    print(f"Time elapsed: {duration:.2f} seconds")
+def _format_duration(duration_ns):
+    for unit, scale in (('s', 10 ** 9), ('ms', 10 ** 6), ('us', 10 ** 3)):
+        if duration_ns >= scale:
+            return f"{duration_ns / scale:.3f} {unit}"
+    return f"{duration_ns} ns"
+
+
+def timer(func, *args, **kwargs):
+    start_time = time.perf_counter_ns()
+    result = func(*args, **kwargs)
+    print(f"Time elapsed: {_format_duration(time.perf_counter_ns() - start_time)}")
     return result
 
 
-import math
+class Histogram:
+    """Counts of durations in nanoseconds, in buckets no wider than 1/8 of their value.
+
+    Recording is a bit_length, a shift and a list increment, so it's cheap enough for
+    hot paths, and the memory doesn't grow with the number of calls. Percentiles are the
+    lower edge of their bucket, at most 12.5% under the exact value. Threads recording
+    at once may, rarely, lose a count.
+    """
+
+    def __init__(self, name, code=None):
+        self.name = name
+        # (filename, first line, function name), for the pstats export.
+        self.code = code or ('~', 0, name)
+        self.buckets = [0] * 512
+        self.count = 0
+        self.total_ns = 0
+        self.sample_every = 1
+
+    def record(self, duration_ns):
+        self.count += 1
+        self.total_ns += duration_ns
+        if duration_ns < 16:
+            self.buckets[duration_ns] += 1
+        else:
+            shift = duration_ns.bit_length() - 4
+            self.buckets[(shift << 3) + (duration_ns >> shift)] += 1
+
+    def percentile(self, fraction):
+        rank = max(1, math.ceil(fraction * self.count))
+        seen = 0
+        for bucket, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= rank:
+                return bucket if bucket < 16 else (bucket % 8 + 8) << (bucket // 8 - 1)
+        return 0
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'sample_every': self.sample_every,
+            'total_ns': self.total_ns,
+            'mean_ns': self.total_ns // self.count if self.count else 0,
+            'p50_ns': self.percentile(0.5),
+            'p99_ns': self.percentile(0.99),
+        }
+
+
+class TimingRegistry:
+    """Histograms of the timed functions and blocks, by name."""
+
+    def __init__(self):
+        self.histograms = {}
+
+    def histogram(self, name, code=None):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(name, code)
+        return self.histograms[name]
+
+    def stats(self):
+        return {name: histogram.stats() for name, histogram in self.histograms.items()}
+
+    def clear(self):
+        self.histograms.clear()
+
+    def report(self):
+        for name, stats in sorted(self.stats().items(), key=lambda item: -item[1]['total_ns']):
+            if not stats['count']:
+                continue
+            print(f"{name}: {stats['count']} calls, p50 {_format_duration(stats['p50_ns'])}, "
+                  f"p99 {_format_duration(stats['p99_ns'])}, total {_format_duration(stats['total_ns'])}")
+
+    def export_json(self, file):
+        """Write the stats of every histogram to a JSON file, given by path or file object."""
+        if isinstance(file, (str, os.PathLike)):
+            with open(file, 'w') as f:
+                return self.export_json(f)
+        json.dump(self.stats(), file, indent=2)
+
+    def export_pstats(self, path):
+        """Write the timings in the format of cProfile's dump_stats, to load with pstats.Stats(path).
+
+        Sampled functions are counted as if every call had been timed. Nested timed calls
+        aren't subtracted, so a function's own time is its cumulative time.
+        """
+        stats = {}
+        for histogram in self.histograms.values():
+            if not histogram.count:
+                continue
+            calls = histogram.count * histogram.sample_every
+            seconds = histogram.total_ns * histogram.sample_every / 10 ** 9
+            filename, first_line, _ = histogram.code
+            # Keyed by the histogram's name: two names can time the same inherited function.
+            stats[filename, first_line, histogram.name] = (calls, calls, seconds, seconds, {})
+        with open(path, 'wb') as file:
+            marshal.dump(stats, file)
+
+
+TIMINGS = TimingRegistry()
+
+
+def timed(func=None, *, name=None, sample_every=1, registry=None):
+    """Decorator that records how long each call of func takes.
+
+    For generator functions, the time spent inside the generator until it's exhausted
+    or closed is recorded, not the time the caller spends between items.
+
+    :param name: Optional, the histogram's name; func's qualified name otherwise.
+    :param int sample_every: Only time one call in this many, to keep the cost down on hot paths.
+    :param registry: Optional, the TimingRegistry to record in; TIMINGS otherwise.
+    """
+    if func is None:
+        return partial(timed, name=name, sample_every=sample_every, registry=registry)
+    code = getattr(func, '__code__', None)
+    histogram = (registry or TIMINGS).histogram(
+        name or func.__qualname__,
+        (code.co_filename, code.co_firstlineno, func.__qualname__) if code else None)
+    histogram.sample_every = sample_every
+    record = histogram.record
+    calls = count()
+
+    if inspect.isgeneratorfunction(func):
+        def run(*args, **kwargs):
+            elapsed_ns = 0
+            generator = func(*args, **kwargs)
+            try:
+                while True:
+                    start_time = time.perf_counter_ns()
+                    try:
+                        item = next(generator)
+                    except StopIteration as stop:
+                        return stop.value
+                    finally:
+                        elapsed_ns += time.perf_counter_ns() - start_time
+                    yield item
+            finally:
+                generator.close()
+                record(elapsed_ns)
+    else:
+        def run(*args, **kwargs):
+            start_time = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(time.perf_counter_ns() - start_time)
+
+    if sample_every == 1:
+        return wraps(func)(run)
+
+    @wraps(func)
+    def sampled(*args, **kwargs):
+        if next(calls) % sample_every:
+            return func(*args, **kwargs)
+        return run(*args, **kwargs)
+    return sampled
+
+
+@contextmanager
+def timing(name, registry=None):
+    """Context manager that records how long its block takes."""
+    histogram = (registry or TIMINGS).histogram(name)
+    start_time = time.perf_counter_ns()
+    try:
+        yield histogram
+    finally:
+        histogram.record(time.perf_counter_ns() - start_time)
+
+
+def instrument(module, names=None, sample_every=1, registry=None):
+    """Time the module's hot functions, replacing them with timed versions.
+
+    :param module: A module, like HW_1_5, HW_1_6 or HW_1_7.
+    :param names: Optional, the functions and 'Class.method's to time; the module's
+        HOT_FUNCTIONS otherwise.
+    :return: The names that were instrumented.
+    """
+    names = module.HOT_FUNCTIONS if names is None else names
+    for name in names:
+        owner_name, _, attribute = name.rpartition('.')
+        owner = getattr(module, owner_name) if owner_name else module
+        func = getattr(owner, attribute)
+        if not hasattr(func, '__wrapped__'):
+            setattr(owner, attribute, timed(func, name=f"{module.__name__}.{name}",
+                                            sample_every=sample_every, registry=registry))
+    return list(names)
+
+
+def uninstrument(module, names=None):
+    """Put back the functions that instrument replaced."""
+    for name in module.HOT_FUNCTIONS if names is None else names:
+        owner_name, _, attribute = name.rpartition('.')
+        owner = getattr(module, owner_name) if owner_name else module
+        func = getattr(owner, attribute)
+        if hasattr(func, '__wrapped__'):
+            setattr(owner, attribute, func.__wrapped__)
 
 
 def sqrt_numbers(strings):
@@ -136,14 +549,178 @@ def get_alphabet():
 
 
 def word_frequency(text):
-    words = text.split()
-    frequency = {}
-    for word in words:
-        if word in frequency:
-            frequency[word] += 1
-        else:
-            frequency[word] = 1
-    return frequency
+    return dict(Counter(text.split()))
+
+
+def _count_words_in_span(filename, start, end, encoding):
+    with open(filename, 'rb') as file:
+        file.seek(start)
+        return Counter(file.read(end - start).decode(encoding).split())
+
+
+def iter_word_counts(filename, workers=None, chunk_size=1 << 22, encoding='utf-8'):
+    """Yield a Counter of the words in each chunk of a file, in file order.
+
+    The file is cut into chunks of about chunk_size bytes at ASCII whitespace. With
+    workers, the chunks are counted in that many processes, with at most two chunks
+    per worker in flight.
+    """
+    with open(filename, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if not workers:
+                for start, end in _word_spans(mm, chunk_size):
+                    yield Counter(mm[start:end].decode(encoding).split())
+                return
+            with ProcessPoolExecutor(workers) as executor:
+                pending = deque()
+                for start, end in _word_spans(mm, chunk_size):
+                    pending.append(executor.submit(_count_words_in_span, filename, start, end, encoding))
+                    if len(pending) >= 2 * workers:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+
+
+def word_frequency_file(filename, workers=None, chunk_size=1 << 22, encoding='utf-8'):
+    """Count the words of a file like word_frequency, one chunk at a time.
+
+    The chunks' counts are merged in file order, so the words keep the order they first appear in.
+    """
+    frequency = Counter()
+    for counts in iter_word_counts(filename, workers, chunk_size, encoding):
+        frequency.update(counts)
+    return dict(frequency)
+
+
+class SpaceSaving:
+    """Approximate counts of the most frequent items, in memory for capacity items.
+
+    This is the Space-Saving algorithm: when a new item arrives and every counter is
+    taken, it replaces the item with the smallest count and inherits that count. Every
+    item seen more than n / capacity times is kept, and each count is too high by at
+    most its error.
+
+    :param int capacity: The number of items to keep counts for.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        # One (count, item) entry per kept item; a count may be behind self.counts until it reaches the top.
+        self._heap = []
+
+    def update(self, items):
+        """Count items, an iterable of items or a mapping from items to counts."""
+        if not isinstance(items, Mapping):
+            items = Counter(items)
+        counts, errors, heap = self.counts, self.errors, self._heap
+        # Rarest first, so a batch's frequent items are the ones left holding counters.
+        for item, count in sorted(items.items(), key=itemgetter(1)):
+            if item in counts:
+                counts[item] += count
+            elif len(counts) < self.capacity:
+                counts[item] = count
+                errors[item] = 0
+                heappush(heap, (count, item))
+            else:
+                smallest, evicted = self._smallest()
+                del counts[evicted], errors[evicted]
+                counts[item] = smallest + count
+                errors[item] = smallest
+                heapreplace(heap, (smallest + count, item))
+
+    def _smallest(self):
+        heap, counts = self._heap, self.counts
+        while heap[0][0] != counts[heap[0][1]]:
+            item = heap[0][1]
+            heapreplace(heap, (counts[item], item))
+        return heap[0]
+
+    def most_common(self, n=None):
+        """The n items with the highest counts and their counts, highest first."""
+        return Counter(self.counts).most_common(n)
+
+
+class CountMinSketch:
+    """Approximate counts of any number of items in a fixed depth x width table.
+
+    Each item adds to one counter per row, picked by a hash of the item, and its count
+    is the smallest of those counters, so it is never too low. With k, the sketch also
+    keeps the k items with the highest counts seen so far.
+
+    :param int width: Counters per row; a count is too high by about n / width at most.
+    :param int depth: Rows; more rows make a large overestimate less likely.
+    :param int k: Optional, the number of heavy hitters to keep for most_common.
+    """
+
+    def __init__(self, width=1 << 16, depth=4, k=None):
+        self.width = width
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self.k = k
+        self.heavy_hitters = {}
+
+    def _columns(self, items):
+        hashes = np.array([int.from_bytes(blake2b(str(item).encode(), digest_size=8).digest(), 'little')
+                           for item in items], dtype=np.uint64)
+        # Derive each row's hash from two halves of one 64-bit hash (Kirsch and Mitzenmacher).
+        first, second = hashes & np.uint64(0xFFFFFFFF), (hashes >> np.uint64(32)) | np.uint64(1)
+        rows = np.arange(len(self.table), dtype=np.uint64)[:, None]
+        return ((first + rows * second) % np.uint64(self.width)).astype(np.intp)
+
+    def update(self, items):
+        """Count items, an iterable of items or a mapping from items to counts."""
+        if not isinstance(items, Mapping):
+            items = Counter(items)
+        if not items:
+            return
+        keys = list(items)
+        rows = np.arange(len(self.table))[:, None]
+        np.add.at(self.table, (rows, self._columns(keys)), np.fromiter(items.values(), dtype=np.int64))
+        if self.k:
+            keys = list(self.heavy_hitters.keys() | items.keys())
+            estimates = self.estimate(keys)
+            self.heavy_hitters = dict(nlargest(self.k, zip(keys, estimates), key=itemgetter(1)))
+
+    def estimate(self, items):
+        """The estimated count of each item."""
+        items = list(items)
+        if not items:
+            return []
+        rows = np.arange(len(self.table))[:, None]
+        return self.table[rows, self._columns(items)].min(axis=0).tolist()
+
+    def merge(self, other):
+        """Add the counts of another sketch of the same shape, like one made in another process."""
+        self.table += other.table
+        if self.k:
+            keys = list(self.heavy_hitters.keys() | other.heavy_hitters.keys())
+            self.heavy_hitters = dict(nlargest(self.k, zip(keys, self.estimate(keys)), key=itemgetter(1)))
+
+    def most_common(self, n=None):
+        """The n heavy hitters with the highest counts and their counts, highest first."""
+        return Counter(self.heavy_hitters).most_common(n)
+
+
+def top_words(filename, k=10, method='exact', workers=None, chunk_size=1 << 22, encoding='utf-8'):
+    """The k most frequent words of a file and their counts, most frequent first.
+
+    method 'exact' counts every word. 'space_saving' and 'count_min' keep memory bounded
+    however many distinct words there are, and their counts may be too high.
+    """
+    if method == 'exact':
+        summary = Counter()
+    elif method == 'space_saving':
+        summary = SpaceSaving(10 * k)
+    elif method == 'count_min':
+        summary = CountMinSketch(k=k)
+    else:
+        raise ValueError(f"{method} is not a valid method.")
+    for counts in iter_word_counts(filename, workers, chunk_size, encoding):
+        summary.update(counts)
+    return summary.most_common(k)
 
 
 def generate_full_names(first_name, last_name, minimum=None):
@@ -156,54 +733,359 @@ def generate_full_names(first_name, last_name, minimum=None):
     return full_names
 
 
+def _as_pixels(image):
+    if isinstance(image, np.ndarray):
+        return image
+    if isinstance(image, (bytes, bytearray)):
+        image = io.BytesIO(image)
+    if not isinstance(image, Image.Image):
+        image = Image.open(image)
+    return np.asarray(image)
+
+
+def _black_mask(pixels, threshold, channel_axis):
+    mask = pixels <= threshold
+    if pixels.ndim == channel_axis + 1:
+        mask = mask.all(axis=channel_axis)
+    return mask
+
+
+def _decode_black_mask(mask):
+    """The characters whose codes are the first black row of each column that has one."""
+    return ''.join(map(chr, mask.argmax(axis=0)[mask.any(axis=0)].tolist()))
+
+
 def find_black_pixels(image_path, threshold=50):
-    image = np.array(Image.open(image_path))
-    black_pixels = []
-    for x in range(image.shape[1]):
-        for y in range(image.shape[0]):
-            pixel = image[y][x]
-            if np.all(pixel <= threshold):
-                black_pixels.append(y)
-                break
-    print(black_pixels)
-    sentence = ''.join(chr(i) for i in black_pixels)
+    """Decode an image made by encrypt_sentence: each column's first black row is a character code.
+
+    image_path can also be a file object, the image's bytes, a PIL image or a pixel array.
+    """
+    sentence = _decode_black_mask(_black_mask(_as_pixels(image_path), threshold, channel_axis=2))
+    print(list(map(ord, sentence)))
     return sentence
 
 
-def group_by(func, arg_list):
-    result_dict = {}
-    for arg in arg_list:
-        result = func(arg)
-        if result in result_dict:
+def find_black_pixels_many(images, threshold=50):
+    """Decode a batch of images, either a (N, height, width, 3) array or an iterable of images."""
+    if isinstance(images, np.ndarray):
+        mask = _black_mask(images, threshold, channel_axis=3)
+        rows, found = mask.argmax(axis=1).tolist(), mask.any(axis=1).tolist()
+        return [''.join(chr(row) for row, is_found in zip(image_rows, image_found) if is_found)
+                for image_rows, image_found in zip(rows, found)]
+    sentences = []
+    for image in images:
+        sentences.append(_decode_black_mask(_black_mask(_as_pixels(image), threshold, channel_axis=2)))
+    return sentences
+
+
+def group_by(func, arg_list, workers=None):
+    """Group the arguments by the result of func, in order.
+
+    With workers, func is called in that many processes, so it must be picklable.
+    """
+    result_dict = defaultdict(list)
+    if not workers:
+        for arg in arg_list:
+            result_dict[func(arg)].append(arg)
+        return dict(result_dict)
+    arg_list = list(arg_list)
+    with ProcessPoolExecutor(workers) as executor:
+        results = executor.map(func, arg_list, chunksize=max(1, len(arg_list) // (4 * workers)))
+        for result, arg in zip(results, arg_list):
             result_dict[result].append(arg)
-        else:
-            result_dict[result] = [arg]
-    return result_dict
+    return dict(result_dict)
 
 
 def zip_with(func, *iterables):
-    result = []
-    for args in zip(*iterables):
-        result.append(func(*args))
-    return tuple(result)
+    return tuple(map(func, *iterables))
+
+
+class _FusedStages:
+    """All of a pipeline's stages as one picklable function over a batch of items."""
+
+    def __init__(self, stages):
+        self.stages = stages
+
+    def __call__(self, batch):
+        for kind, func in self.stages:
+            batch = list(map(func, batch)) if kind == 'apply' else list(filter(func, batch))
+        return batch
+
 
+class Pipeline:
+    """A lazy chain of apply and my_filter stages over an iterable.
 
-def encrypt_sentence(sentence):
-    mx_let = max(ord(c) for c in sentence) + 1
-    image = Image.new('RGB', (mx_let, mx_let), color=(255, 255, 255))
-    pixels = image.load()
+    Nothing runs, and no stage is materialized, until the pipeline is iterated. On its
+    own the pipeline stacks the built-in map and filter iterators. With a thread or
+    process backend, items go to the pool in batches and all the stages are fused into
+    one task per batch, so each item crosses to a worker once. A process backend needs
+    picklable funcs, so no lambdas.
 
-    for i, char in enumerate(sentence):
-        pixel_value = ord(char)
-        col_index = i
-        row_index = pixel_value
-        pixels[col_index, row_index] = (0, 0, 0)
+    :param iterable: The items to run through the stages.
+    """
 
-    # Save the image in the same directory as the script
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    image_path = os.path.join(script_dir, "encrypted_image.png")
-    image.save(image_path)
+    def __init__(self, iterable, stages=()):
+        self.iterable = iterable
+        self.stages = tuple(stages)
 
+    @classmethod
+    def zip_with(cls, func, *iterables):
+        """A pipeline over func applied to the items of the iterables side by side, like zip_with."""
+        return cls(map(func, *iterables))
+
+    def apply(self, func):
+        return Pipeline(self.iterable, self.stages + (('apply', func),))
+
+    def my_filter(self, func):
+        return Pipeline(self.iterable, self.stages + (('my_filter', func),))
+
+    def run(self, backend=None, workers=None, ordered=True, batch_size=256):
+        """Iterate over the results.
+
+        :param backend: Optional, 'thread' or 'process' to run the stages in a pool.
+        :param workers: Optional, the pool's size; the executor's default otherwise.
+        :param bool ordered: Whether to keep the input order. Otherwise batches come out
+            as soon as they're done, which helps when some items take much longer.
+        :param int batch_size: The number of items per task sent to the pool.
+        """
+        if backend is None:
+            return self._run_serially()
+        if backend == 'thread':
+            executor = ThreadPoolExecutor(workers)
+        elif backend == 'process':
+            executor = ProcessPoolExecutor(workers)
+        else:
+            raise ValueError(f"{backend} is not a valid backend.")
+        # Keep two batches per worker in flight, so the input is read as the output is consumed.
+        return self._run_in_pool(executor, 2 * (workers or os.cpu_count() or 1), ordered, batch_size)
+
+    def _run_serially(self):
+        items = iter(self.iterable)
+        for kind, func in self.stages:
+            items = map(func, items) if kind == 'apply' else filter(func, items)
+        return items
+
+    def _run_in_pool(self, executor, window, ordered, batch_size):
+        fused = _FusedStages(self.stages)
+        items = iter(self.iterable)
+        with executor:
+            pending = deque() if ordered else set()
+            while batch := list(islice(items, batch_size)):
+                if ordered:
+                    pending.append(executor.submit(fused, batch))
+                    if len(pending) >= window:
+                        yield from pending.popleft().result()
+                else:
+                    pending.add(executor.submit(fused, batch))
+                    if len(pending) >= window:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            yield from future.result()
+            if ordered:
+                while pending:
+                    yield from pending.popleft().result()
+            else:
+                for future in as_completed(pending):
+                    yield from future.result()
+
+    def __iter__(self):
+        return self.run()
+
+
+def _encode_sentences(sentences):
+    lengths = np.array([len(sentence) for sentence in sentences], dtype=np.intp)
+    codes = np.array([ord(char) for char in ''.join(sentences)], dtype=np.intp)
+    size = int(codes.max()) + 1
+    pixels = np.full((len(sentences), size, max(size, int(lengths.max())), 3), 255, dtype=np.uint8)
+    image_index = np.repeat(np.arange(len(sentences)), lengths)
+    col_index = np.arange(len(codes)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    pixels[image_index, codes, col_index] = 0
+    return pixels
+
+
+def encrypt_sentence(sentence, output='file', image_path=None):
+    """Draw each character as a black pixel in its column, at the row of its character code.
+
+    output picks what is returned: 'file' saves the image (by default next to the script)
+    and returns it, 'image' returns it without saving, 'array' returns the pixels and
+    'bytes' returns the PNG file's contents.
+    """
+    pixels = _encode_sentences([sentence])[0]
+    if output == 'array':
+        return pixels
+    image = Image.fromarray(pixels, 'RGB')
+    if output == 'bytes':
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+        return buffer.getvalue()
+    if output == 'file':
+        # Save the image in the same directory as the script
+        if image_path is None:
+            script_dir = os.path.dirname(os.path.abspath(__file__))
+            image_path = os.path.join(script_dir, "encrypted_image.png")
+        image.save(image_path)
+    elif output != 'image':
+        raise ValueError(f"{output} is not a valid output.")
     return image
 
 
+def encrypt_sentences(sentences):
+    """Encode a batch of sentences as one (N, height, width, 3) array, padded with white to the largest one."""
+    return _encode_sentences(list(sentences))
+
+
+def compare_image_codec(length=2_000, max_code=2_000, threshold=50):
+    """Compare the pixel-by-pixel encoder and decoder with the vectorized ones on a large image."""
+    def encrypt_by_pixel(sentence):
+        mx_let = max(ord(c) for c in sentence) + 1
+        image = Image.new('RGB', (mx_let, mx_let), color=(255, 255, 255))
+        pixels = image.load()
+        for i, char in enumerate(sentence):
+            pixels[i, ord(char)] = (0, 0, 0)
+        return image
+
+    def find_by_pixel(image):
+        image = np.array(image)
+        black_pixels = []
+        for x in range(image.shape[1]):
+            for y in range(image.shape[0]):
+                if np.all(image[y][x] <= threshold):
+                    black_pixels.append(y)
+                    break
+        return ''.join(chr(i) for i in black_pixels)
+
+    rng = np.random.default_rng(0)
+    sentence = ''.join(map(chr, rng.integers(32, max_code, length).tolist()))
+
+    start_time = time.perf_counter()
+    image = encrypt_by_pixel(sentence)
+    print(f"encode pixel by pixel: {time.perf_counter() - start_time:.4f}s")
+    start_time = time.perf_counter()
+    pixels = encrypt_sentence(sentence, output='array')
+    print(f"encode vectorized: {time.perf_counter() - start_time:.4f}s")
+    assert np.array_equal(pixels, np.asarray(image))
+
+    start_time = time.perf_counter()
+    assert find_by_pixel(image) == sentence
+    print(f"decode pixel by pixel: {time.perf_counter() - start_time:.4f}s")
+    start_time = time.perf_counter()
+    assert find_black_pixels_many([image], threshold) == [sentence]
+    print(f"decode vectorized: {time.perf_counter() - start_time:.4f}s")
+
+
+def compare_find_states_same_row(filename, repeats=5):
+    """Compare checking every character against every row with the bitmask classifier."""
+    def find_by_row(filename):
+        with open(filename, 'r') as file:
+            states = file.read().split()
+        rows = ['qwertyuiop', 'asdfghjkl', 'zxcvbnm']
+        return [state for state in states if any(all(char.lower() in row for char in state) for row in rows)]
+
+    assert find_by_row(filename) == find_states_same_row(filename)
+    return benchmark({'per row': find_by_row, 'bitmask': find_states_same_row}, filename, repeats=repeats)
+
+
+def compare_word_frequency(filename, repeats=3, workers=4):
+    """Compare counting the words of a file with an if/else per word and with each aggregation mode."""
+    def word_frequency_by_branch(filename):
+        with open(filename, 'r') as file:
+            words = file.read().split()
+        frequency = {}
+        for word in words:
+            if word in frequency:
+                frequency[word] += 1
+            else:
+                frequency[word] = 1
+        return frequency
+
+    def word_frequency_by_counter(filename):
+        with open(filename, 'r') as file:
+            return word_frequency(file.read())
+
+    assert word_frequency_by_branch(filename) == word_frequency_file(filename, workers)
+    return benchmark({
+        'if/else': word_frequency_by_branch,
+        'Counter': word_frequency_by_counter,
+        'chunked': word_frequency_file,
+        'map-reduce': lambda filename: word_frequency_file(filename, workers, chunk_size=1 << 20),
+        'space-saving top 10': lambda filename: top_words(filename, method='space_saving'),
+        'count-min top 10': lambda filename: top_words(filename, method='count_min'),
+    }, filename, repeats=repeats)
+
+
+def _wait_briefly(x):
+    time.sleep(0.001)
+    return x
+
+
+def _sum_of_squares(x):
+    return sum(i * i for i in range(x % 100 + 2000))
+
+
+def _is_odd(x):
+    return x % 2
+
+
+def compare_pipeline_backends(workers=4, repeats=3):
+    """Compare the pipeline's backends on cheap, waiting (I/O-like) and CPU-bound stages.
+
+    Serial wins when each item is cheap, threads win when the stages wait, and processes
+    win when the stages are CPU-bound and there are cores to spread them over.
+    """
+    cases = {
+        'cheap': (_is_odd, 200_000),
+        'waiting': (_wait_briefly, 1_000),
+        'cpu-bound': (_sum_of_squares, 5_000),
+    }
+    results = {}
+    for case, (func, n) in cases.items():
+        print(f"{case} ({n} items):")
+        results[case] = benchmark({
+            backend or 'serial': lambda n, backend=backend: Pipeline(range(n)).apply(func).my_filter(_is_odd).run(
+                backend, workers, batch_size=max(1, n // (8 * workers)))
+            for backend in (None, 'thread', 'process')
+        }, n, warmup=0, repeats=repeats, trace_memory=False)
+    return results
+
+
+def compare_calc(n=100_000, repeats=5):
+    """Compare calc as it was, with its dispatch rebuilt on every call, against calc, calc_expressions and calc_many."""
+    def calc_rebuilding_ops(op, a, b):
+        def add(a, b):
+            return a + b
+
+        def subtract(a, b):
+            return a - b
+
+        def multiply(a, b):
+            return a * b
+
+        def divide(a, b):
+            return a / b
+
+        ops = {'+': add, '-': subtract, '*': multiply, '/': divide}
+        if op not in ops:
+            return None
+        return ops[op](a, b)
+
+    rng = np.random.default_rng(0)
+    ops = rng.choice(list(_CALC_OPS), n).tolist()
+    a_list, b_list = rng.integers(-1000, 1000, n).tolist(), rng.integers(1, 1000, n).tolist()
+    expressions = list(zip(ops, a_list, b_list))
+    a_array, b_array = np.array(a_list), np.array(b_list)
+
+    assert [calc_rebuilding_ops(*expression) for expression in expressions] == calc_expressions(expressions)
+    large = [('*', 2 ** 40, 2 ** 40), ('+', 2 ** 63, 1), ('-', -2 ** 63, 1), ('-', True, False),
+             ('/', 2 ** 60 + 1, 3), ('*', 2 ** 70, -3), ('+', 2 ** 62, 2 ** 62), ('/', 2 ** 53, 2 ** 53 - 1)]
+    assert [calc(*expression) for expression in large] == calc_expressions(large)
+    assert [[calc(*expression)] for expression in large] == [calc_expressions([expression]) for expression in large]
+    for mixed in ([('+', 2 ** 60 + 1, 1), ('+', 0.5, 1.5)], [('+', 3, 4), ('+', 0.5, 1)],
+                  [('*', 2, 3.0), ('-', True, 2)]):
+        assert repr([calc(*expression) for expression in mixed]) == repr(calc_expressions(mixed))
+    assert calc_many('+', [2 ** 63, 1], [1, 1]).tolist() == [2 ** 63 + 1, 2]
+    return benchmark({
+        'calc, rebuilding its ops': lambda expressions: [calc_rebuilding_ops(*e) for e in expressions],
+        'calc': lambda expressions: [calc(*e) for e in expressions],
+        'calc_expressions': calc_expressions,
+        'calc_many per operator': lambda expressions: [calc_many(op, a_array, b_array) for op in _CALC_OPS],
+    }, expressions, repeats=repeats, trace_memory=False)
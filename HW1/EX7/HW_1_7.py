@@ -1,4 +1,31 @@
+import asyncio
+import bisect
+import io
+import json
 import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import traceback
+import tracemalloc
+from array import array
+from collections import defaultdict, deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, nullcontext
+from itertools import chain, count
+
+import numpy as np
+
+# The functions HW_1_6.instrument times by default.
+HOT_FUNCTIONS = (
+    'PostOffice.send_message', 'PostOffice.read_inbox', 'PostOffice.search_inbox', 'PostOffice.broadcast',
+    'PostOffice2.send_message', 'PostOffice2.read_inbox', 'PostOffice2.search_inbox', 'PostOffice2.broadcast',
+    'SearchIndex.search',
+)
 
 
 class Poll:
@@ -35,6 +62,139 @@ class Poll:
             return "Tie"
 
 
+class LivePoll(Poll):
+    """A Poll that keeps track of the leader as votes come in, so get_winner is O(1).
+
+    It knows the highest number of votes, how many options have it, and which option
+    that is when there's only one.
+    """
+
+    def __init__(self, question, options):
+        super().__init__(question, options)
+        self._recount()
+
+    def _recount(self):
+        self._max_votes = max(self.votes, default=0)
+        self._num_leaders = self.votes.count(self._max_votes)
+        self._leader = self.votes.index(self._max_votes) if self.votes else None
+
+    def vote(self, option_index):
+        if not 0 <= option_index < len(self.options):
+            raise ValueError("Invalid option index")
+        votes = self.votes[option_index] + 1
+        self.votes[option_index] = votes
+        if votes > self._max_votes:
+            self._max_votes, self._num_leaders, self._leader = votes, 1, option_index
+        elif votes == self._max_votes:
+            self._num_leaders += 1
+
+    def vote_many(self, option_indexes):
+        """Count a batch of votes, given as the option index of each vote."""
+        option_indexes = np.asarray(option_indexes, dtype=np.intp)
+        if not len(option_indexes):
+            return
+        if option_indexes.min() < 0 or option_indexes.max() >= len(self.options):
+            raise ValueError("Invalid option index")
+        tally = np.bincount(option_indexes, minlength=len(self.votes))
+        self.votes[:] = (np.array(self.votes, dtype=np.int64) + tally).tolist()
+        self._recount()
+
+    def add_option(self, option):
+        super().add_option(option)
+        if self._max_votes == 0:
+            self._num_leaders += 1
+            if self._leader is None:
+                self._leader = len(self.votes) - 1
+
+    def remove_option(self, option_index):
+        removed_votes = self.votes[option_index] if 0 <= option_index < len(self.votes) else None
+        super().remove_option(option_index)
+        if removed_votes == self._max_votes:
+            self._recount()
+        elif self._leader > option_index:
+            self._leader -= 1
+
+    def get_winner(self):
+        if not self.votes:
+            raise ValueError("The poll has no options")
+        if self._num_leaders == 1:
+            return self.options[self._leader]
+        else:
+            return "Tie"
+
+
+class _PollShard:
+    __slots__ = ('lock', 'counts')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = defaultdict(int)
+
+
+class ShardedPoll(LivePoll):
+    """A LivePoll for many threads voting at once.
+
+    Each thread counts its votes in its own shard, behind a lock that only it and merges
+    take, so voters don't contend with each other. get_votes, get_winner and option
+    changes merge the shards into the totals first, so read votes through get_votes
+    rather than the votes attribute.
+    """
+
+    def __init__(self, question, options):
+        self._lock = threading.Lock()
+        self._shards = []
+        self._local = threading.local()
+        super().__init__(question, options)
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _PollShard()
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def vote(self, option_index):
+        shard = self._shard()
+        with shard.lock:
+            if not 0 <= option_index < len(self.options):
+                raise ValueError("Invalid option index")
+            shard.counts[option_index] += 1
+
+    def _merge(self):
+        # Called with self._lock and every shard's lock held.
+        merged = False
+        for shard in self._shards:
+            for option_index, count in shard.counts.items():
+                self.votes[option_index] += count
+                merged = True
+            shard.counts.clear()
+        if merged:
+            self._recount()
+
+    def _merged(self, method, *args):
+        with self._lock, ExitStack() as stack:
+            for shard in self._shards:
+                stack.enter_context(shard.lock)
+            self._merge()
+            return method(*args)
+
+    def vote_many(self, option_indexes):
+        return self._merged(super().vote_many, option_indexes)
+
+    def add_option(self, option):
+        return self._merged(super().add_option, option)
+
+    def remove_option(self, option_index):
+        return self._merged(super().remove_option, option_index)
+
+    def get_votes(self):
+        return self._merged(super().get_votes)
+
+    def get_winner(self):
+        return self._merged(super().get_winner)
+
+
 class Point:
     def __init__(self, x, y):
         self.x = x
@@ -55,18 +215,930 @@ class Point:
         return math.sqrt(dx ** 2 + dy ** 2)
 
 
-class PostOffice:
+def _largest_magnitude(array):
+    return max(abs(int(array.min())), abs(int(array.max())))
+
+
+def _coordinate_array(coordinates):
+    """The coordinates as an int64 array if they are all integers under 2**62 in size, so that
+    adding or subtracting two such arrays can't overflow, and as a float array otherwise."""
+    array = np.asarray(coordinates)
+    if array.dtype.kind in 'biu' and (array.size == 0 or _largest_magnitude(array) < 2 ** 62):
+        return array.astype(np.int64, copy=False)
+    return array.astype(float, copy=False)
+
+
+class PointArray:
+    """Many points as one (N, 2) array, with vectorized arithmetic and distances.
+
+    Indexing with an int gives a Point, iterating gives Points, and Points can be added,
+    subtracted and measured against the whole array. Integer coordinates under 2**62 in size
+    are kept as int64, so integer Points come back as they went in; any other coordinates
+    make the whole array float. Distances are always floats.
+
+    :param coordinates: The points' (x, y) pairs, as anything np.asarray takes.
+    """
+
+    def __init__(self, coordinates):
+        self.xy = _coordinate_array(coordinates).reshape(-1, 2)
+
+    @classmethod
+    def from_points(cls, points):
+        return cls([(point.x, point.y) for point in points])
+
+    def to_points(self):
+        return [Point(x, y) for x, y in self.xy.tolist()]
+
+    def _coordinates(self, other):
+        if isinstance(other, Point):
+            return _coordinate_array([other.x, other.y])
+        if isinstance(other, PointArray):
+            return other.xy
+        return _coordinate_array(other)
+
+    def __len__(self):
+        return len(self.xy)
+
+    def __iter__(self):
+        return iter(self.to_points())
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return Point(*self.xy[index].tolist())
+        return PointArray(self.xy[index])
+
+    def __add__(self, other):
+        return PointArray(self.xy + self._coordinates(other))
+
+    def __sub__(self, other):
+        return PointArray(self.xy - self._coordinates(other))
+
+    def __str__(self):
+        return f"[{', '.join(map(str, self))}]"
+
+    def distance(self, other):
+        """The distance from each point to other: a Point, or a PointArray paired up point by point."""
+        delta = (self.xy - self._coordinates(other)).astype(float, copy=False)
+        return np.sqrt(delta[..., 0] ** 2 + delta[..., 1] ** 2)
+
+    def iter_pairwise_distances(self, other=None, chunk_size=1024):
+        """Yield (start, block) pieces of the distance matrix from these points to other's.
+
+        block holds the distances of rows start to start + chunk_size, so only one block of
+        chunk_size x len(other) distances is in memory at a time.
+        """
+        other = self.xy if other is None else self._coordinates(other)
+        for start in range(0, len(self.xy), chunk_size):
+            delta = (self.xy[start:start + chunk_size, None, :] - other[None, :, :]).astype(float, copy=False)
+            yield start, np.sqrt(delta[..., 0] ** 2 + delta[..., 1] ** 2)
+
+    def pairwise_distances(self, other=None, chunk_size=1024):
+        """The (len(self), len(other)) matrix of distances, computed chunk_size rows at a time."""
+        columns = len(self.xy) if other is None else len(self._coordinates(other))
+        distances = np.empty((len(self.xy), columns))
+        for start, block in self.iter_pairwise_distances(other, chunk_size):
+            distances[start:start + len(block)] = block
+        return distances
+
+    def index(self, cell_size=None):
+        return GridIndex(self, cell_size)
+
+
+class GridIndex:
+    """A uniform grid over a PointArray, for k-nearest and radius queries.
+
+    The points are sorted by cell, so each column of cells is one slice of that order,
+    and a query only looks at the cells around it, widening the square of cells until
+    it is sure nothing closer is outside.
+
+    :param PointArray points: The points to index.
+    :param float cell_size: Optional, the side of a cell; by default about two points a cell.
+    """
+
+    def __init__(self, points, cell_size=None):
+        self.points = points
+        xy = points.xy
+        self.origin = xy.min(axis=0).astype(float) if len(xy) else np.zeros(2)
+        extent = xy.max(axis=0) - self.origin if len(xy) else np.zeros(2)
+        if cell_size is None:
+            area = extent[0] * extent[1] or max(extent.max(), 1.0) ** 2 / max(len(xy), 1)
+            cell_size = math.sqrt(2 * area / max(len(xy), 1)) or 1.0
+        self.cell_size = cell_size
+        cells = self._cells(xy)
+        self.num_columns, self.num_rows = (cells.max(axis=0) + 1).tolist() if len(xy) else (1, 1)
+        cell_ids = cells[:, 0] * self.num_rows + cells[:, 1]
+        self.order = np.argsort(cell_ids, kind='stable')
+        # starts[c]:starts[c + 1] is the slice of order in cell c.
+        self.starts = np.zeros(self.num_columns * self.num_rows + 1, dtype=np.intp)
+        np.cumsum(np.bincount(cell_ids, minlength=self.num_columns * self.num_rows), out=self.starts[1:])
+
+    def _cells(self, xy):
+        return np.floor((xy - self.origin) / self.cell_size).astype(np.int64)
+
+    def _candidates(self, column, row, ring):
+        first_row, last_row = max(row - ring, 0), min(row + ring, self.num_rows - 1)
+        slices = [
+            self.order[self.starts[c * self.num_rows + first_row]:self.starts[c * self.num_rows + last_row + 1]]
+            for c in range(max(column - ring, 0), min(column + ring, self.num_columns - 1) + 1)
+        ] if first_row <= last_row else []
+        return np.concatenate(slices) if slices else np.zeros(0, dtype=np.intp)
+
+    def _covers_grid(self, column, row, ring):
+        return (column - ring <= 0 and column + ring >= self.num_columns - 1
+                and row - ring <= 0 and row + ring >= self.num_rows - 1)
+
+    def _distances(self, indexes, point):
+        delta = (self.points.xy[indexes] - point).astype(float, copy=False)
+        return np.sqrt(delta[:, 0] ** 2 + delta[:, 1] ** 2)
+
+    def nearest(self, point, k=1):
+        """The indexes of the k points nearest to point and their distances, nearest first.
+
+        Ties are broken by index.
+        """
+        point = self.points._coordinates(point)
+        k = min(k, len(self.points))
+        if k <= 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0)
+        column, row = self._cells(point).tolist()
+        # Start from the nearest ring of cells that reaches the grid.
+        ring = max(0, -column, column - self.num_columns + 1, -row, row - self.num_rows + 1)
+        while True:
+            indexes = self._candidates(column, row, ring)
+            covers_grid = self._covers_grid(column, row, ring)
+            if len(indexes) >= k or covers_grid:
+                distances = self._distances(indexes, point)
+                kth_distance = np.partition(distances, k - 1)[k - 1]
+                # Everything within ring cells of the point's cell has been seen.
+                if covers_grid or kth_distance <= ring * self.cell_size:
+                    nearest = np.lexsort((indexes, distances))[:k]
+                    return indexes[nearest], distances[nearest]
+                ring = max(ring + 1, math.ceil(kth_distance / self.cell_size))
+            else:
+                ring = 2 * ring + 1
+
+    def within(self, point, radius):
+        """The indexes of the points at most radius from point, in increasing order."""
+        point = self.points._coordinates(point)
+        column, row = self._cells(point).tolist()
+        indexes = self._candidates(column, row, math.ceil(radius / self.cell_size))
+        return np.sort(indexes[self._distances(indexes, point) <= radius])
+
+
+class DictStore:
+    """Message storage that keeps every message as a plain dict.
+
+    A message store creates the objects kept in the PO Boxes ("handles") and
+    knows how to read their fields back. Handles of this store are the message
+    dicts themselves. Stores that persist the boxes also take the recipient and
+    urgency of new messages, are told when a message is removed, and can restore
+    the boxes (see LogStore).
+
+    :param bool read_flag: Whether new messages get a 'read': False entry.
+    """
+
+    def __init__(self, read_flag=True):
+        self.read_flag = read_flag
+
+    def new(self, message_id, sender, body, recipient=None, urgent=False):
+        message = {'id': message_id, 'body': body, 'sender': sender}
+        if self.read_flag:
+            message['read'] = False  # Added to track whether message has been read
+        return message
+
+    def message_id(self, handle):
+        return handle['id']
+
+    def body(self, handle):
+        return handle['body']
+
+    def sender(self, handle):
+        return handle['sender']
+
+    def is_read(self, handle):
+        return handle.get('read', False)
+
+    def mark_read(self, handle, read=True):
+        handle['read'] = read
+
+    def discard(self, handle):
+        pass
+
+    def view(self, handle):
+        """Get the dict-like message a handle stands for."""
+        return handle
+
+
+class ReadFlags:
+    """A growable bitset, one bit per message."""
+
+    def __init__(self):
+        self.bits = bytearray()
+
+    def __getitem__(self, i):
+        byte = i >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 << (i & 7)))
+
+    def __setitem__(self, i, value):
+        byte = i >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(byte - len(self.bits) + 1))
+        if value:
+            self.bits[byte] |= 1 << (i & 7)
+        else:
+            self.bits[byte] &= ~(1 << (i & 7))
+
+
+class Message:
+    """A compact, immutable message record."""
+
+    __slots__ = ('id', 'body', 'sender')
+
+    def __init__(self, message_id, body, sender):
+        self.id = message_id
+        self.body = body
+        self.sender = sender
+
+
+class MessageView(Mapping):
+    """A dict-like view of a stored message, with the keys 'id', 'body', 'sender' and 'read'.
+
+    Only 'read' can be assigned; the change is written back to the store.
+    """
+
+    __slots__ = ('_store', '_handle')
+    _keys = ('id', 'body', 'sender', 'read')
+
+    def __init__(self, store, handle):
+        self._store = store
+        self._handle = handle
+
+    def __getitem__(self, key):
+        if key == 'id':
+            return self._store.message_id(self._handle)
+        if key == 'body':
+            return self._store.body(self._handle)
+        if key == 'sender':
+            return self._store.sender(self._handle)
+        if key == 'read':
+            return self._store.is_read(self._handle)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key != 'read':
+            raise KeyError(f"{key} can't be changed")
+        self._store.mark_read(self._handle, value)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class _MessageViewStore:
+    """Base for the stores whose messages are read through a MessageView rather than kept as dicts."""
+
+    def discard(self, handle):
+        pass
+
+    def view(self, handle):
+        return MessageView(self, handle)
+
+
+class CompactStore(_MessageViewStore):
+    """Message storage that keeps every message as a slotted Message record.
+
+    Sender names are interned, so each distinct sender is stored once, and the
+    read flags live in a bitset indexed by message id instead of in the records.
+    """
+
+    def __init__(self):
+        self.senders = {}
+        self.read_flags = ReadFlags()
+
+    def new(self, message_id, sender, body, recipient=None, urgent=False):
+        sender = self.senders.setdefault(sender, sender)
+        return Message(message_id, body, sender)
+
+    def message_id(self, handle):
+        return handle.id
+
+    def body(self, handle):
+        return handle.body
+
+    def sender(self, handle):
+        return handle.sender
+
+    def is_read(self, handle):
+        return self.read_flags[handle.id]
+
+    def mark_read(self, handle, read=True):
+        self.read_flags[handle.id] = read
+
+
+class ColumnarStore(_MessageViewStore):
+    """Message storage that keeps every field in a column shared by all messages.
+
+    Handles are row numbers. Ids are kept in an array('q'), senders as indexes
+    into a table of interned names, and the UTF-8 encoded bodies back to back
+    in a single bytearray arena. Removed messages are not reclaimed.
+    """
+
+    def __init__(self):
+        self.ids = array('q')
+        self.sender_numbers = array('l')
+        self.sender_names = []
+        self._sender_numbers = {}
+        self.arena = bytearray()
+        self.offsets = array('q', [0])
+        self.read_flags = ReadFlags()
+
+    def new(self, message_id, sender, body, recipient=None, urgent=False):
+        row = len(self.ids)
+        self.ids.append(message_id)
+        sender_number = self._sender_numbers.get(sender)
+        if sender_number is None:
+            sender_number = self._sender_numbers[sender] = len(self.sender_names)
+            self.sender_names.append(sender)
+        self.sender_numbers.append(sender_number)
+        self.arena += body.encode()
+        self.offsets.append(len(self.arena))
+        return row
+
+    def message_id(self, handle):
+        return self.ids[handle]
+
+    def body(self, handle):
+        return self.arena[self.offsets[handle]:self.offsets[handle + 1]].decode()
+
+    def sender(self, handle):
+        return self.sender_names[self.sender_numbers[handle]]
+
+    def is_read(self, handle):
+        return self.read_flags[handle]
+
+    def mark_read(self, handle, read=True):
+        self.read_flags[handle] = read
+
+
+class LogStore(_MessageViewStore):
+    """Message storage persisted in a directory, so PO Boxes survive a restart.
+
+    The directory holds three files:
+
+    * ``messages.log`` - an append-only log of message records, each a header
+      (id, urgency, field lengths) followed by the UTF-8 recipient, sender and body.
+    * ``messages.idx`` - the log offset of every record as int64, memory mapped so
+      any record is found in O(1) without parsing the log.
+    * ``messages.state`` - one byte of read / removed flags per record.
+
+    Handles are record numbers. Bodies are decoded straight from the memory mapped
+    log only when they are needed. On opening, a torn record at the end of the log
+    is dropped, records missing from the index are re-indexed, and if enough of the
+    log belongs to removed messages it is compacted.
+
+    :param str path: The directory to keep the mailbox in. Created if it doesn't exist.
+    :param float compact_ratio: Compact on opening when more than this share of the records were removed.
+    :param bool fsync: Whether to fsync after every write, trading speed for durability on power loss.
+    """
+
+    HEADER = struct.Struct('<qBHHI')
+    OFFSET = struct.Struct('<q')
+    URGENT = 1
+    READ = 1
+    REMOVED = 2
+    FILES = ('messages.log', 'messages.idx', 'messages.state')
+
+    def __init__(self, path, compact_ratio=0.5, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        os.makedirs(path, exist_ok=True)
+        self._finish_compaction()
+        self._recover()
+        self._open()
+        removed = self.states.count(self.REMOVED) + self.states.count(self.REMOVED | self.READ)
+        if removed and removed > compact_ratio * len(self.states):
+            self.close()
+            self._compact()
+            self._open()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _recover(self):
+        """Bring the index and state files back in line with the log after a crash."""
+        for name in self.FILES:
+            open(self._file(name), 'ab').close()
+        with open(self._file('messages.log'), 'r+b') as log, open(self._file('messages.idx'), 'r+b') as idx:
+            log_size = os.fstat(log.fileno()).st_size
+            data = idx.read()
+            offsets = array('q', data[:len(data) - len(data) % self.OFFSET.size])
+            # Drop index entries whose record did not fully make it to the log.
+            while offsets and self._record_end(log, offsets[-1], log_size) is None:
+                offsets.pop()
+            position = self._record_end(log, offsets[-1], log_size) if offsets else 0
+            # Index the records that made it to the log but not to the index.
+            while True:
+                end = self._record_end(log, position, log_size)
+                if end is None:
+                    break
+                offsets.append(position)
+                position = end
+            log.truncate(position)
+            idx.seek(0)
+            idx.write(offsets.tobytes())
+            idx.truncate()
+        with open(self._file('messages.state'), 'r+b') as state:
+            state.truncate(len(offsets))
+
+    def _record_end(self, log, offset, log_size):
+        if offset + self.HEADER.size > log_size:
+            return None
+        log.seek(offset)
+        _, _, recipient_len, sender_len, body_len = self.HEADER.unpack(log.read(self.HEADER.size))
+        end = offset + self.HEADER.size + recipient_len + sender_len + body_len
+        return end if end <= log_size else None
+
+    def _open(self):
+        self._log = open(self._file('messages.log'), 'ab')
+        self._idx = open(self._file('messages.idx'), 'ab')
+        self._state = open(self._file('messages.state'), 'r+b', buffering=0)
+        self.states = bytearray(self._state.read())
+        self._log_map = self._offsets = None
+        self._map()
+        self._log_size = os.fstat(self._log.fileno()).st_size
+
+    def _map(self):
+        """(Re)map the log and the index to see what was written since the last mapping."""
+        self._unmap()
+        with open(self._file('messages.log'), 'rb') as log:
+            if os.fstat(log.fileno()).st_size:
+                self._log_map = mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(self._file('messages.idx'), 'rb') as idx:
+            if os.fstat(idx.fileno()).st_size:
+                self._idx_map = mmap.mmap(idx.fileno(), 0, access=mmap.ACCESS_READ)
+                self._offsets = memoryview(self._idx_map).cast('q')
+        self._mapped = len(self._offsets) if self._offsets is not None else 0
+
+    def _unmap(self):
+        if self._offsets is not None:
+            self._offsets.release()
+            self._idx_map.close()
+            self._offsets = None
+        if self._log_map is not None:
+            self._log_map.close()
+            self._log_map = None
+
+    def _write(self, file, data):
+        file.write(data)
+        file.flush()
+        if self.fsync:
+            os.fsync(file.fileno())
+
+    def new(self, message_id, sender, body, recipient=None, urgent=False):
+        recipient, sender, body = recipient.encode(), sender.encode(), body.encode()
+        header = self.HEADER.pack(message_id, self.URGENT if urgent else 0, len(recipient), len(sender), len(body))
+        offset = self._log_size
+        # The log goes first: a record missing from the index is recovered, an index entry without its record is not.
+        self._write(self._log, header + recipient + sender + body)
+        self._log_size += len(header) + len(recipient) + len(sender) + len(body)
+        self._write(self._idx, self.OFFSET.pack(offset))
+        self.states.append(0)
+        self._set_state(len(self.states) - 1, 0)
+        return len(self.states) - 1
+
+    def _record(self, handle):
+        """Get the header fields and the memory mapped log holding a record."""
+        if handle >= self._mapped:
+            # Written after the files were mapped; everything written is flushed, so a new mapping sees it.
+            self._map()
+        offset = self._offsets[handle]
+        return offset + self.HEADER.size, self.HEADER.unpack_from(self._log_map, offset)
+
+    def _field(self, handle, field):
+        start, (_, _, recipient_len, sender_len, body_len) = self._record(handle)
+        lengths = (recipient_len, sender_len, body_len)
+        start += sum(lengths[:field])
+        with memoryview(self._log_map) as log:
+            return str(log[start:start + lengths[field]], 'utf-8')
+
+    def message_id(self, handle):
+        return self._record(handle)[1][0]
+
+    def body(self, handle):
+        return self._field(handle, 2)
+
+    def sender(self, handle):
+        return self._field(handle, 1)
+
+    def is_read(self, handle):
+        return bool(self.states[handle] & self.READ)
+
+    def _set_state(self, handle, state):
+        self.states[handle] = state
+        self._state.seek(handle)
+        self._write(self._state, bytes((state,)))
+
+    def mark_read(self, handle, read=True):
+        state = self.states[handle]
+        self._set_state(handle, state | self.READ if read else state & ~self.READ)
+
+    def discard(self, handle):
+        self._set_state(handle, self.states[handle] | self.REMOVED)
+
+    def restore(self):
+        """Go over the messages still in their boxes, in the order they were sent.
+
+        :return: Tuples of (recipient, handle, urgent, read), and the id of the last message ever sent.
+        :rtype: tuple[list, int]
+        """
+        if not self.states:
+            return [], 0
+        self._map()
+        log, offsets, unpack_from = self._log_map, self._offsets, self.HEADER.unpack_from
+        header_size = self.HEADER.size
+        recipients = {}
+        messages = []
+        for handle, state in enumerate(self.states):
+            if state & self.REMOVED:
+                continue
+            offset = offsets[handle]
+            _, flags, recipient_len, _, _ = unpack_from(log, offset)
+            recipient = log[offset + header_size:offset + header_size + recipient_len]
+            recipient = recipients.setdefault(recipient, str(recipient, 'utf-8'))
+            messages.append((recipient, handle, bool(flags & self.URGENT), bool(state & self.READ)))
+        # Ids only grow, so the last record holds the last id.
+        return messages, self.message_id(len(self.states) - 1)
+
+    def _compact(self):
+        """Rewrite the files without the removed messages.
+
+        New files are written next to the old ones and only swapped in once a
+        marker file says they are complete, so a crash leaves either the old or
+        the new mailbox, never a mix.
+        """
+        with open(self._file('messages.log'), 'rb') as log, \
+                open(self._file('messages.idx'), 'rb') as idx, \
+                open(self._file('messages.state'), 'rb') as state, \
+                open(self._file('compact.log'), 'wb') as new_log, \
+                open(self._file('compact.idx'), 'wb') as new_idx, \
+                open(self._file('compact.state'), 'wb') as new_state:
+            offsets = array('q', idx.read())
+            states = state.read()
+            log_size = os.fstat(log.fileno()).st_size
+            for offset, end, record_state in zip(offsets, chain(offsets[1:], [log_size]), states):
+                # The last record stays even if removed, it holds the id to continue counting from.
+                if record_state & self.REMOVED and end != log_size:
+                    continue
+                log.seek(offset)
+                new_idx.write(self.OFFSET.pack(new_log.tell()))
+                new_log.write(log.read(end - offset))
+                new_state.write(bytes((record_state,)))
+            for new_file in (new_log, new_idx, new_state):
+                new_file.flush()
+                os.fsync(new_file.fileno())
+        open(self._file('compact.done'), 'wb').close()
+        self._finish_compaction()
+
+    def _finish_compaction(self):
+        if os.path.exists(self._file('compact.done')):
+            for name in self.FILES:
+                compacted = self._file(name.replace('messages', 'compact'))
+                if os.path.exists(compacted):
+                    os.replace(compacted, self._file(name))
+            os.remove(self._file('compact.done'))
+        else:
+            # An interrupted compaction: the old files are still whole.
+            for name in self.FILES:
+                compacted = self._file(name.replace('messages', 'compact'))
+                if os.path.exists(compacted):
+                    os.remove(compacted)
+
+    def close(self):
+        self._unmap()
+        for file in (self._log, self._idx, self._state):
+            file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SearchIndex:
+    """An n-gram inverted index over the message bodies of one PO Box.
+
+    A query is answered by intersecting the posting sets of its n-grams and
+    checking only the surviving candidates, instead of every message in the box.
+
+    :ivar int gram: The n-gram length.
+    :ivar dict postings: Maps each n-gram to the ids of the messages containing it.
+
+    :param store: The message store the indexed messages come from.
+    :param int gram: The n-gram length. Queries shorter than this can't use the index.
+    """
+
+    def __init__(self, store, gram=3):
+        self.store = store
+        self.gram = gram
+        self.postings = defaultdict(set)
+        self._messages = {}
+
+    def _grams(self, text):
+        return {text[i:i + self.gram] for i in range(len(text) - self.gram + 1)}
+
+    def add(self, message, urgent=False):
+        """Index a message.
+
+        :param message: The message handle to index.
+        :param bool urgent: Whether the message sits in the urgent part of the box.
+        """
+        message_id = self.store.message_id(message)
+        # Box order: urgent messages newest first, then regular ones oldest first.
+        order = (0, -message_id) if urgent else (1, message_id)
+        self._messages[message_id] = (order, message)
+        for gram in self._grams(self.store.body(message)):
+            self.postings[gram].add(message_id)
+
+    def discard(self, message):
+        """Remove a message from the index, if it is there.
+
+        :param message: The message handle to remove.
+        """
+        message_id = self.store.message_id(message)
+        if self._messages.pop(message_id, None) is None:
+            return
+        for gram in self._grams(self.store.body(message)):
+            posting = self.postings[gram]
+            posting.discard(message_id)
+            if not posting:
+                del self.postings[gram]
+
+    def search(self, search_string):
+        """Find the indexed messages containing a string.
+
+        :param str search_string: The string to search for.
+        :return: The matching messages in box order, or None if a plain scan would be cheaper.
+        :rtype: list or None
+        """
+        if len(search_string) < self.gram:
+            return None
+        postings = sorted((self.postings.get(gram, ()) for gram in self._grams(search_string)), key=len)
+        if 2 * len(postings[0]) > len(self._messages):
+            # Most of the box is a candidate anyway.
+            return None
+        candidates = set(postings[0]).intersection(*postings[1:])
+        found = [self._messages[message_id] for message_id in candidates]
+        found = [entry for entry in found if search_string in self.store.body(entry[1])]
+        found.sort(key=lambda entry: entry[0])
+        return [message for _, message in found]
+
+    def __len__(self):
+        return len(self._messages)
+
+
+class Inbox:
+    """A user's PO Box. Urgent messages come first, newest to oldest, then the
+    regular messages in the order they arrived.
+
+    Sending and popping are O(1), so draining a box is linear in its size.
+
+    :ivar deque urgent: Urgent messages, newest first.
+    :ivar deque regular: Regular messages, oldest first.
+    :ivar SearchIndex index: Optional search index, kept up to date as messages come and go.
+
+    :param store: The message store the handles kept in this box come from. Default is a DictStore.
+    """
+
+    def __init__(self, store=None):
+        self.store = DictStore() if store is None else store
+        self.urgent = deque()
+        self.regular = deque()
+        self.index = None
+
+    def add(self, message, urgent=False, read=False):
+        """Put a message in the box.
+
+        :param message: The message handle to store.
+        :param bool urgent: Whether the message jumps ahead of the regular ones.
+        :param bool read: Whether the message was already read, when restoring a box.
+        """
+        if urgent:
+            self.urgent.appendleft(message)
+        else:
+            self.regular.append(message)
+        if self.index is not None:
+            self.index.add(message, urgent)
+
+    def pop(self, num_msgs=None):
+        """Remove messages from the front of the box.
+
+        :param int num_msgs: The number of messages to remove. Default is None, which removes all of them.
+        :return: The removed messages, in box order.
+        :rtype: list
+        """
+        if num_msgs is None:
+            num_msgs = len(self)
+        messages = []
+        while len(messages) < num_msgs and self.urgent:
+            messages.append(self.urgent.popleft())
+        while len(messages) < num_msgs and self.regular:
+            messages.append(self.regular.popleft())
+        if self.index is not None:
+            for message in messages:
+                self.index.discard(message)
+        return messages
+
+    def build_index(self, gram=3):
+        """Start keeping a search index for this box, indexing the messages already in it.
+
+        :param int gram: The n-gram length of the index.
+        :return: The new index.
+        :rtype: SearchIndex
+        """
+        self.index = SearchIndex(self.store, gram)
+        for message in self.urgent:
+            self.index.add(message, urgent=True)
+        for message in self.regular:
+            self.index.add(message)
+        return self.index
+
+    def search(self, search_string):
+        """Find the messages containing a string, using the search index when possible.
+
+        :param str search_string: The string to search for.
+        :return: The matching messages, in box order.
+        :rtype: list
+        """
+        if self.index is not None:
+            found = self.index.search(search_string)
+            if found is not None:
+                return found
+        body = self.store.body
+        return [msg for msg in self if search_string in body(msg)]
+
+    def __iter__(self):
+        return chain(self.urgent, self.regular)
+
+    def __len__(self):
+        return len(self.urgent) + len(self.regular)
+
+
+class ReadTrackingInbox(Inbox):
+    """A PO Box that keeps messages after they are read.
+
+    Unread urgent messages are kept on a stack (the newest one is read first)
+    and unread regular messages are found through a cursor, so reading never
+    rescans messages that were already read.
+
+    :ivar list regular: Regular messages, oldest first.
+    :ivar int unread: The number of messages that were not read yet.
+    """
+
+    def __init__(self, store=None):
+        super().__init__(store)
+        self.regular = []
+        self._unread_urgent = []
+        self._cursor = 0
+
+    def add(self, message, urgent=False, read=False):
+        super().add(message, urgent)
+        if not read:
+            if urgent:
+                self._unread_urgent.append(message)
+        elif not urgent and self._cursor == len(self.regular) - 1:
+            # Regular messages are read in order, so the read ones are all before the cursor.
+            self._cursor += 1
+
+    def read(self, num_msgs=None):
+        """Get the next unread messages, leaving them in the box.
+
+        :param int num_msgs: The number of messages to read, so 0 reads none. Default is None, which reads all
+            unread messages.
+        :return: The messages read, in box order.
+        :rtype: list
+        """
+        if num_msgs is None:
+            num_msgs = self.unread
+        messages = []
+        while len(messages) < num_msgs and self._unread_urgent:
+            messages.append(self._unread_urgent.pop())
+        while len(messages) < num_msgs and self._cursor < len(self.regular):
+            messages.append(self.regular[self._cursor])
+            self._cursor += 1
+        return messages
+
+    def pop(self, num_msgs=None):
+        raise TypeError("Messages can't be removed from a read-tracking inbox")
+
+    @property
+    def unread(self):
+        return len(self._unread_urgent) + len(self.regular) - self._cursor
+
+
+def _restore_boxes(post_office, inbox_class):
+    """Put back the boxes kept by a store that can restore them, like a LogStore.
+
+    :param post_office: A post office with boxes, a store and a message_id.
+    :param type inbox_class: The class of the boxes made for users the post office doesn't have yet.
+    """
+    if not hasattr(post_office.store, 'restore'):
+        return
+    messages, post_office.message_id = post_office.store.restore()
+    for recipient, msg, urgent, read in messages:
+        if recipient not in post_office.boxes:
+            post_office.boxes[recipient] = inbox_class(post_office.store)
+        post_office.boxes[recipient].add(msg, urgent, read)
+
+
+class _BulkSending:
+    """send_many and broadcast, shared by the post offices that keep boxes, a store and a message_id."""
+
+    def send_many(self, messages, urgent=False):
+        """Send many messages at once.
+
+        Ids are allocated as one block, and nothing is sent if any of the recipients does not exist.
+
+        :param messages: (sender, recipient, message_body) tuples.
+        :type messages: iterable[tuple]
+        :param urgent: The urgency of the messages.
+        :type urgent: bool, optional
+        :return: The message IDs, in the order of messages.
+        :rtype: list[int]
+        :raises KeyError: if a recipient does not exist.
+        """
+        messages = list(messages)
+        user_boxes = [self.boxes[recipient] for _, recipient, _ in messages]
+        first_id = self.message_id + 1
+        self.message_id += len(messages)
+        new = self.store.new
+        new_msgs = [new(message_id, sender, message_body, recipient, urgent)
+                    for message_id, (sender, recipient, message_body) in zip(count(first_id), messages)]
+        for user_box, msg in zip(user_boxes, new_msgs):
+            user_box.add(msg, urgent)
+        return list(range(first_id, self.message_id + 1))
+
+    def broadcast(self, sender, recipients, message_body, urgent=False):
+        """Send the same message to many recipients.
+
+        :param str sender: The message sender's username.
+        :param list recipients: The message recipients' usernames.
+        :param str message_body: The body of the message.
+        :param urgent: The urgency of the message.
+        :type urgent: bool, optional
+        :return: The message IDs, one per recipient.
+        :rtype: list[int]
+        :raises KeyError: if a recipient does not exist.
+        """
+        return self.send_many(((sender, recipient, message_body) for recipient in recipients), urgent)
+
+
+class _InboxSearching:
+    """search_inbox and index_inbox, shared by the post offices that keep boxes and a store."""
+
+    def search_inbox(self, username, search_string):
+        """Search for messages in a user's inbox containing a search string.
+
+        :param str username: The name of the user whose inbox we want to search.
+        :param str search_string: The string to search for.
+        :return: A list of dictionaries representing the messages containing the search string.
+        :rtype: list[dict]
+        :raises KeyError: if the user does not exist.
+        """
+        return [self.store.view(msg) for msg in self.boxes[username].search(search_string)]
+
+    def index_inbox(self, username, gram=3):
+        """Keep a full-text search index for a user's inbox, to speed up search_inbox.
+
+        :param str username: The name of the user whose inbox should be indexed.
+        :param int gram: The n-gram length of the index.
+        :raises KeyError: if the user does not exist.
+        """
+        self.boxes[username].build_index(gram)
+
+
+class PostOffice(_BulkSending, _InboxSearching):
     """A Post Office class. Allows users to message each other.
 
     :ivar int message_id: Incremental id of the last message sent.
     :ivar dict boxes: Users' inboxes.
+    :ivar store: Where the messages are kept.
 
     :param list usernames: Users for which we should create PO Boxes.
+    :param store: Optional message store, e.g. a CompactStore, a ColumnarStore or a LogStore. Default is a DictStore.
+        The boxes kept by a LogStore are restored, including those of users missing from usernames.
     """
 
-    def __init__(self, usernames):
+    def __init__(self, usernames, store=None):
         self.message_id = 0
-        self.boxes = {user: [] for user in usernames}
+        self.store = DictStore() if store is None else store
+        self.boxes = {user: ReadTrackingInbox(self.store) for user in usernames}
+        _restore_boxes(self, ReadTrackingInbox)
 
     def send_message(self, sender, recipient, message_body, urgent=False):
         """Send a message to a recipient.
@@ -82,52 +1154,22 @@ class PostOffice:
         """
         user_box = self.boxes[recipient]
         self.message_id += 1
-        message_details = {
-            'id': self.message_id,
-            'body': message_body,
-            'sender': sender,
-            'read': False  # Added to track whether message has been read
-        }
-        if urgent:
-            user_box.insert(0, message_details)
-        else:
-            user_box.append(message_details)
+        user_box.add(self.store.new(self.message_id, sender, message_body, recipient, urgent), urgent)
         return self.message_id
 
     def read_inbox(self, username, num_msgs=None):
         """Read a number of messages in a user's inbox.
 
         :param str username: The name of the user whose inbox we want to read.
-        :param int num_msgs: Optional, the number of messages to read. Default is None, which will read all messages.
+        :param int num_msgs: Optional, the number of messages to read, so 0 reads none. Default is None, which will
+            read all messages.
         :return: A list of dictionaries representing the messages read.
         :rtype: list[dict]
         """
-        user_box = self.boxes[username]
-        if num_msgs is None:
-            num_msgs = len(user_box)
-        msgs = []
-        for msg in user_box:
-            if not msg['read']:
-                msgs.append(msg)
-                msg['read'] = True
-            if len(msgs) == num_msgs:
-                break
-        return msgs
-
-    def search_inbox(self, username, search_string):
-        """Search for messages in a user's inbox containing a search string.
-
-        :param str username: The name of the user whose inbox we want to search.
-        :param str search_string: The string to search for.
-        :return: A list of dictionaries representing the messages containing the search string.
-        :rtype: list[dict]
-        """
-        user_box = self.boxes[username]
-        found_msgs = []
-        for msg in user_box:
-            if search_string in msg['body']:
-                found_msgs.append(msg)
-        return found_msgs
+        msgs = self.boxes[username].read(num_msgs)
+        for msg in msgs:
+            self.store.mark_read(msg)
+        return [self.store.view(msg) for msg in msgs]
 
 
 class Player:
@@ -172,18 +1214,23 @@ class Enemy:
             print(f"{self.name} has been defeated!")
 
 
-class PostOffice2:
+class PostOffice2(_BulkSending, _InboxSearching):
     """A Post Office class. Allows users to message each other.
 
     :ivar int message_id: Incremental id of the last message sent.
     :ivar dict boxes: Users' inboxes.
+    :ivar store: Where the messages are kept.
 
     :param list usernames: Users for which we should create PO Boxes.
+    :param store: Optional message store, e.g. a CompactStore, a ColumnarStore or a LogStore. Default is a DictStore.
+        The boxes kept by a LogStore are restored, including those of users missing from usernames.
     """
 
-    def __init__(self, usernames):
+    def __init__(self, usernames, store=None):
         self.message_id = 0
-        self.boxes = {user: [] for user in usernames}
+        self.store = DictStore(read_flag=False) if store is None else store
+        self.boxes = {user: Inbox(self.store) for user in usernames}
+        _restore_boxes(self, Inbox)
 
     def send_message(self, sender, recipient, message_body, urgent=False):
         """Send a message to a recipient.
@@ -199,15 +1246,7 @@ class PostOffice2:
         """
         user_box = self.boxes[recipient]
         self.message_id = self.message_id + 1
-        message_details = {
-            'id': self.message_id,
-            'body': message_body,
-            'sender': sender,
-        }
-        if urgent:
-            user_box.insert(0, message_details)
-        else:
-            user_box.append(message_details)
+        user_box.add(self.store.new(self.message_id, sender, message_body, recipient, urgent), urgent)
         return self.message_id
 
     def read_inbox(self, recipient, num_msgs=None):
@@ -219,33 +1258,76 @@ class PostOffice2:
         :rtype: list
         :raises KeyError: if the recipient does not exist.
         """
-        user_box = self.boxes[recipient]
-        if num_msgs is None:
-            num_msgs = len(user_box)
-        messages = []
-        for i in range(num_msgs):
-            if not user_box:
-                break
-            msg = user_box.pop(0)
-            msg['read'] = True
-            messages.append(msg)
-        return messages
+        messages = self.boxes[recipient].pop(num_msgs)
+        for msg in messages:
+            self.store.mark_read(msg)
+            self.store.discard(msg)
+        return [self.store.view(msg) for msg in messages]
 
-    def search_inbox(self, recipient, search_string):
-        """Search a recipient's inbox for messages containing a string.
+    def iter_lines(self):
+        """Generate the lines of the PostOffice's string representation, one at a time.
 
-        :param str recipient: The message recipient's username.
-        :param str search_string: The string to search for.
-        :return: A list of matching messages.
-        :rtype: list
-        :raises KeyError: if the recipient does not exist.
+        :return: The lines, each ending with a newline.
+        :rtype: iterator[str]
         """
-        user_box = self.boxes[recipient]
-        matches = []
-        for msg in user_box:
-            if search_string in msg['body']:
-                matches.append(msg)
-        return matches
+        for user, inbox in self.boxes.items():
+            yield f'{user}:\n'
+            if not inbox:
+                yield 'No messages.\n'
+            for msg in map(self.store.view, inbox):
+                yield f'Message {msg["id"]} from {msg["sender"]}: {msg["body"]}\n'
+
+    def export(self, file):
+        """Write the PostOffice's string representation to a file, without building it in memory.
+
+        :param file: A text file-like object.
+        """
+        file.writelines(self.iter_lines())
+
+    def export_jsonl(self, file):
+        """Back up the PostOffice to a file, as JSON lines.
+
+        The first line holds the last message id. Each box is then a {"user": ...}
+        line followed by one line per message, with the urgent messages from the
+        oldest to the newest so that sending them again in file order rebuilds the box.
+
+        :param file: A text file-like object.
+        """
+        file.write(json.dumps({'message_id': self.message_id}) + '\n')
+        for user, inbox in self.boxes.items():
+            file.write(json.dumps({'user': user}) + '\n')
+            for urgent, msgs in ((True, reversed(inbox.urgent)), (False, inbox.regular)):
+                for msg in map(self.store.view, msgs):
+                    line = {'recipient': user, 'id': msg['id'], 'sender': msg['sender'], 'body': msg['body'],
+                            'urgent': urgent}
+                    file.write(json.dumps(line) + '\n')
+
+    def import_jsonl(self, file):
+        """Restore a backup written by export_jsonl, one line at a time.
+
+        Messages keep their ids, so this is meant for an empty PostOffice.
+        Boxes are created for users that don't have one yet.
+
+        :param file: A text file-like object.
+        :return: The number of messages restored.
+        :rtype: int
+        """
+        num_msgs = 0
+        for line in file:
+            entry = json.loads(line)
+            if 'message_id' in entry:
+                self.message_id = max(self.message_id, entry['message_id'])
+                continue
+            if 'user' in entry:
+                if entry['user'] not in self.boxes:
+                    self.boxes[entry['user']] = Inbox(self.store)
+                continue
+            user_box = self.boxes[entry['recipient']]
+            msg = self.store.new(entry['id'], entry['sender'], entry['body'], entry['recipient'], entry['urgent'])
+            user_box.add(msg, entry['urgent'])
+            self.message_id = max(self.message_id, entry['id'])
+            num_msgs += 1
+        return num_msgs
 
     def __str__(self):
         """String representation of the PostOffice.
@@ -253,14 +1335,458 @@ class PostOffice2:
         :return: A string representation of the PostOffice.
         :rtype: str
         """
-        out = ''
-        for user, inbox in self.boxes.items():
-            out += f'{user}:\n'
-            if not inbox:
-                out += 'No messages.\n'
-            for msg in inbox:
-                out += f'Message {msg["id"]} from {msg["sender"]}: {msg["body"]}\n'
-        return out
+        out = io.StringIO()
+        self.export(out)
+        return out.getvalue()
+
+
+class ConcurrentPostOffice(PostOffice):
+    """A PostOffice that can be shared between threads.
+
+    Every PO Box has its own lock, so users never wait for each other's boxes,
+    and message ids come from an atomic allocator. read_inbox can block until
+    new mail arrives. Stores other than DictStore are shared by all the boxes,
+    so calls to them are serialized, and the messages they return are copied
+    into plain dicts that stay valid outside the locks.
+
+    :param list usernames: Users for which we should create PO Boxes.
+    :param store: Optional message store. Default is a DictStore.
+    """
+
+    def __init__(self, usernames, store=None):
+        super().__init__(usernames, store)
+        self._id_lock = threading.Lock()
+        self._store_lock = nullcontext() if isinstance(self.store, DictStore) else threading.Lock()
+        # Each condition's lock is also the lock of the box.
+        self._new_mail = {user: threading.Condition() for user in self.boxes}
+        self._listeners = {user: [] for user in self.boxes}
+
+    def _next_id(self):
+        with self._id_lock:
+            self.message_id += 1
+            return self.message_id
+
+    def _view(self, msg):
+        if isinstance(self.store, DictStore):
+            return self.store.view(msg)
+        return dict(self.store.view(msg))
+
+    def send_message(self, sender, recipient, message_body, urgent=False):
+        new_mail = self._new_mail[recipient]
+        with new_mail:
+            # Taking the id under the box lock keeps ids increasing within each box.
+            message_id = self._next_id()
+            with self._store_lock:
+                msg = self.store.new(message_id, sender, message_body, recipient, urgent)
+                # A box with a search index reads the message back from the store.
+                self.boxes[recipient].add(msg, urgent)
+            listeners, self._listeners[recipient] = self._listeners[recipient], []
+            new_mail.notify_all()
+        self._call_listeners(listeners)
+        return message_id
+
+    @staticmethod
+    def _call_listeners(listeners):
+        for listener in listeners:
+            try:
+                listener()
+            except Exception:
+                # The message is already delivered; one broken listener mustn't keep the others from hearing of it.
+                traceback.print_exc()
+
+    def send_many(self, messages, urgent=False):
+        messages = list(messages)
+        recipients = sorted({recipient for _, recipient, _ in messages})
+        with ExitStack() as stack:
+            # Boxes are always locked in the same order, so two batches can't deadlock.
+            new_mails = [self._new_mail[recipient] for recipient in recipients]
+            for new_mail in new_mails:
+                stack.enter_context(new_mail)
+            with self._id_lock, self._store_lock:
+                message_ids = super().send_many(messages, urgent)
+            listeners = []
+            for recipient, new_mail in zip(recipients, new_mails):
+                listeners += self._listeners[recipient]
+                self._listeners[recipient] = []
+                new_mail.notify_all()
+        self._call_listeners(listeners)
+        return message_ids
+
+    def read_inbox(self, username, num_msgs=None, wait=False, timeout=None):
+        """Read a number of messages in a user's inbox.
+
+        :param str username: The name of the user whose inbox we want to read.
+        :param int num_msgs: Optional, the number of messages to read. Default is None, which will read all messages.
+        :param bool wait: Whether to block until there is at least one unread message.
+        :param float timeout: Optional, the longest time to wait, in seconds.
+        :return: A list of dictionaries representing the messages read, empty if the wait timed out.
+        :rtype: list[dict]
+        """
+        new_mail = self._new_mail[username]
+        with new_mail:
+            user_box = self.boxes[username]
+            if wait:
+                new_mail.wait_for(lambda: user_box.unread, timeout)
+            return self._read(user_box, num_msgs)
+
+    def _read(self, user_box, num_msgs):
+        msgs = user_box.read(num_msgs)
+        with self._store_lock:
+            for msg in msgs:
+                self.store.mark_read(msg)
+            return [self._view(msg) for msg in msgs]
+
+    def read_or_listen(self, username, num_msgs, listener):
+        """Read a user's messages, or if there are none, call listener once the next one arrives.
+
+        The check and the registration happen under the box lock, so no message can slip in between.
+        The listener is called from the thread that sends the message.
+
+        :param str username: The name of the user whose inbox we want to read.
+        :param int num_msgs: The number of messages to read, None for all of them.
+        :param listener: A function taking no arguments.
+        :return: The messages read.
+        :rtype: list[dict]
+        """
+        with self._new_mail[username]:
+            msgs = self._read(self.boxes[username], num_msgs)
+            if not msgs:
+                self._listeners[username].append(listener)
+            return msgs
+
+    def unlisten(self, username, listener):
+        """Take back a listener registered by read_or_listen, if it hasn't been called yet."""
+        with self._new_mail[username]:
+            if listener in self._listeners[username]:
+                self._listeners[username].remove(listener)
+
+    def search_inbox(self, username, search_string):
+        with self._new_mail[username]:
+            with self._store_lock:
+                return [self._view(msg) for msg in self.boxes[username].search(search_string)]
+
+    def index_inbox(self, username, gram=3):
+        with self._new_mail[username]:
+            with self._store_lock:
+                self.boxes[username].build_index(gram)
+
+
+class AsyncPostOffice:
+    """An asyncio front for a ConcurrentPostOffice.
+
+    Sending and reading only touch memory, so they run right in the event loop,
+    while read_inbox(wait=True) long-polls without blocking it. Messages sent
+    from other threads through post_office wake the waiting readers too.
+
+    :ivar ConcurrentPostOffice post_office: The underlying post office.
+
+    :param list usernames: Users for which we should create PO Boxes.
+    :param store: Optional message store. Default is a DictStore.
+    """
+
+    def __init__(self, usernames, store=None):
+        self.post_office = ConcurrentPostOffice(usernames, store)
+
+    async def send_message(self, sender, recipient, message_body, urgent=False):
+        return self.post_office.send_message(sender, recipient, message_body, urgent)
+
+    async def read_inbox(self, username, num_msgs=None, wait=False, timeout=None):
+        """Read a number of messages in a user's inbox.
+
+        :param str username: The name of the user whose inbox we want to read.
+        :param int num_msgs: Optional, the number of messages to read. Default is None, which will read all messages.
+        :param bool wait: Whether to wait until there is at least one unread message.
+        :param float timeout: Optional, the longest time to wait, in seconds.
+        :return: A list of dictionaries representing the messages read, empty if the wait timed out.
+        :rtype: list[dict]
+        """
+        if not wait:
+            return self.post_office.read_inbox(username, num_msgs)
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            new_mail = loop.create_future()
+
+            def wake_up():
+                try:
+                    loop.call_soon_threadsafe(lambda: new_mail.done() or new_mail.set_result(None))
+                except RuntimeError:
+                    # The loop is closed, so nobody is waiting anymore.
+                    pass
+
+            msgs = self.post_office.read_or_listen(username, num_msgs, wake_up)
+            if msgs:
+                return msgs
+            remaining = None if deadline is None else deadline - loop.time()
+            try:
+                # Another reader may take the new mail first, in which case we go back to waiting.
+                await asyncio.wait_for(new_mail, remaining)
+            except asyncio.TimeoutError:
+                return []
+            finally:
+                # Timed out or cancelled, no message should call back into this loop.
+                self.post_office.unlisten(username, wake_up)
+
+    async def search_inbox(self, username, search_string):
+        return self.post_office.search_inbox(username, search_string)
+
+
+def compare_search_inbox(num_msgs=100_000, queries=('lorem', 'ipsum dolor', 'zzz', 'ad')):
+    """Compare search_inbox with and without a search index on a large inbox."""
+    rng = random.Random(0)
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet']
+    words += [''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.randint(3, 9))) for _ in range(5000)]
+    scanned = PostOffice2(['user'])
+    indexed = PostOffice2(['user'])
+    indexed.index_inbox('user')
+    for _ in range(num_msgs):
+        body = ' '.join(rng.choices(words, k=8))
+        scanned.send_message('sender', 'user', body)
+        indexed.send_message('sender', 'user', body)
+
+    for query in queries:
+        scan_start_time = time.perf_counter()
+        scan_result = scanned.search_inbox('user', query)
+        scan_elapsed_time = time.perf_counter() - scan_start_time
+
+        index_start_time = time.perf_counter()
+        index_result = indexed.search_inbox('user', query)
+        index_elapsed_time = time.perf_counter() - index_start_time
+
+        assert [msg['id'] for msg in scan_result] == [msg['id'] for msg in index_result]
+        print(f"{query!r}: {len(scan_result)} matches, scan: {scan_elapsed_time:.4f}s, index: {index_elapsed_time:.4f}s")
+
+
+def compare_message_memory(num_msgs=1_000_000):
+    """Compare the memory taken by a full inbox with each message store."""
+    senders = [f'user{i}' for i in range(100)]
+    for store in (DictStore(), CompactStore(), ColumnarStore()):
+        tracemalloc.start()
+        post_office = PostOffice(['user'], store)
+        for i in range(num_msgs):
+            post_office.send_message(senders[i % len(senders)], 'user', f'message number {i}')
+        memory_used, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{type(store).__name__}: {memory_used / num_msgs:.1f} bytes per message")
+
+
+def check_log_store_recovery(num_msgs=10):
+    """Crash a LogStore in each way it has to survive, and check what reopening it recovers.
+
+    Covers a torn record at the end of the log, with and without its index entry,
+    records missing from the index, a torn index entry, a lost state file, and a
+    compaction interrupted before its marker file was written, after it, and halfway
+    through swapping the files in.
+    """
+    def fill(path, num_msgs, touch=True):
+        with LogStore(path) as store:
+            for i in range(num_msgs):
+                store.new(i + 1, 'a', f'message {i}', 'b', urgent=i % 3 == 0)
+            if touch:
+                store.mark_read(1)
+                store.discard(2)
+
+    def contents(path):
+        with LogStore(path, compact_ratio=1) as store:
+            messages, last_id = store.restore()
+            return [(recipient, store.message_id(handle), store.body(handle), urgent, read)
+                    for recipient, handle, urgent, read in messages], last_id
+
+    def crashed(crash, num_msgs=num_msgs, touch=True):
+        with tempfile.TemporaryDirectory() as path:
+            fill(path, num_msgs, touch)
+            crash(path)
+            recovered = contents(path)
+            assert not any(name.startswith('compact') for name in os.listdir(path)), os.listdir(path)
+            # Reopening again finds nothing more to recover.
+            assert contents(path) == recovered
+            return recovered
+
+    def resize(path, name, change):
+        with open(os.path.join(path, name), 'r+b') as file:
+            file.truncate(os.fstat(file.fileno()).st_size + change)
+
+    def append(path, name, data):
+        with open(os.path.join(path, name), 'ab') as file:
+            file.write(data)
+
+    def compact_until_marker(path, swapped=()):
+        store = LogStore(path, compact_ratio=1)
+        store.close()
+        store._finish_compaction = lambda: None
+        store._compact()
+        for name in swapped:
+            os.replace(os.path.join(path, name.replace('messages', 'compact')), os.path.join(path, name))
+
+    expected = crashed(lambda path: None)
+    one_less = crashed(lambda path: None, num_msgs - 1)
+    assert len(expected[0]) == num_msgs - 1 and expected[1] == num_msgs
+
+    # The last record was only partly written to the log.
+    assert crashed(lambda path: resize(path, 'messages.log', -3)) == one_less
+    # A record was partly written to the log, and the crash came before its index entry.
+    torn_record = LogStore.HEADER.pack(num_msgs + 1, 0, 1, 1, 10) + b'bamess'
+    assert crashed(lambda path: append(path, 'messages.log', torn_record)) == expected
+    # The last record made it to the log but not to the index.
+    assert crashed(lambda path: resize(path, 'messages.idx', -LogStore.OFFSET.size)) == expected
+    # The last index entry was only partly written.
+    assert crashed(lambda path: resize(path, 'messages.idx', -3)) == expected
+    # The state file was lost: every message is back, unread.
+    assert crashed(lambda path: os.remove(os.path.join(path, 'messages.state'))) == \
+        crashed(lambda path: None, touch=False)
+    # A compaction was interrupted while writing its files, which are thrown away.
+    assert crashed(lambda path: [append(path, name.replace('messages', 'compact'), b'half')
+                                 for name in LogStore.FILES]) == expected
+    # A compaction was interrupted after its marker, before or while swapping the files in.
+    assert crashed(compact_until_marker) == expected
+    assert crashed(lambda path: compact_until_marker(path, LogStore.FILES[:1])) == expected
+    assert crashed(lambda path: compact_until_marker(path, LogStore.FILES[:2])) == expected
+    print("LogStore recovered from every crash")
+
+
+def compare_concurrent_post_office(num_threads=8, num_msgs=100_000):
+    """Stress a ConcurrentPostOffice with sender and reader threads, and compare its throughput with PostOffice."""
+    usernames = [f'user{i}' for i in range(num_threads)]
+
+    plain = PostOffice(usernames)
+    start_time = time.perf_counter()
+    for i in range(num_msgs):
+        plain.send_message('sender', usernames[i % num_threads], f'message {i}')
+    for user in usernames:
+        plain.read_inbox(user)
+    plain_elapsed_time = time.perf_counter() - start_time
+
+    concurrent = ConcurrentPostOffice(usernames)
+    received = {user: [] for user in usernames}
+    per_thread = num_msgs // num_threads
+
+    def send(thread_number):
+        for i in range(per_thread):
+            concurrent.send_message('sender', usernames[(thread_number + i) % num_threads], f'message {i}')
+
+    def read(user):
+        while len(received[user]) < per_thread:
+            received[user].extend(concurrent.read_inbox(user, wait=True, timeout=1))
+
+    threads = [threading.Thread(target=send, args=(i,)) for i in range(num_threads)]
+    threads += [threading.Thread(target=read, args=(user,)) for user in usernames]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    concurrent_elapsed_time = time.perf_counter() - start_time
+
+    ids = [msg['id'] for msgs in received.values() for msg in msgs]
+    assert sorted(ids) == list(range(1, per_thread * num_threads + 1)), "Lost or duplicated messages"
+    print(f"PostOffice: {num_msgs / plain_elapsed_time:,.0f} messages/s")
+    print(f"ConcurrentPostOffice, {num_threads} senders and {num_threads} readers: "
+          f"{per_thread * num_threads / concurrent_elapsed_time:,.0f} messages/s")
+
+
+def compare_broadcast(num_users=1000, num_rounds=100):
+    """Compare broadcast with a loop of send_message calls."""
+    usernames = [f'user{i}' for i in range(num_users)]
+
+    looped = PostOffice2(usernames)
+    loop_start_time = time.perf_counter()
+    for i in range(num_rounds):
+        for user in usernames:
+            looped.send_message('admin', user, f'announcement {i}')
+    loop_elapsed_time = time.perf_counter() - loop_start_time
+
+    broadcasted = PostOffice2(usernames)
+    broadcast_start_time = time.perf_counter()
+    for i in range(num_rounds):
+        broadcasted.broadcast('admin', usernames, f'announcement {i}')
+    broadcast_elapsed_time = time.perf_counter() - broadcast_start_time
+
+    assert str(looped) == str(broadcasted)
+    num_msgs = num_users * num_rounds
+    print(f"send_message loop: {num_msgs / loop_elapsed_time:,.0f} messages/s")
+    print(f"broadcast: {num_msgs / broadcast_elapsed_time:,.0f} messages/s")
+
+
+def compare_poll(num_votes=1_000_000, num_options=1_000, read_every=10, batch_size=10_000, num_threads=8):
+    """Compare tallying votes with live leaderboard reads in a Poll and in the new poll engines."""
+    rng = np.random.default_rng(0)
+    ballots = rng.integers(0, num_options, num_votes)
+    ballot_list = ballots.tolist()
+    options = [f'option {i}' for i in range(num_options)]
+
+    for poll_class in (Poll, LivePoll):
+        poll = poll_class('Which option?', list(options))
+        start_time = time.perf_counter()
+        for i, option_index in enumerate(ballot_list):
+            poll.vote(option_index)
+            if i % read_every == 0:
+                poll.get_winner()
+        print(f"{poll_class.__name__}.vote loop: {time.perf_counter() - start_time:.4f}s")
+        expected = poll.get_votes(), poll.get_winner()
+
+    poll = LivePoll('Which option?', list(options))
+    start_time = time.perf_counter()
+    for start in range(0, num_votes, batch_size):
+        poll.vote_many(ballots[start:start + batch_size])
+        poll.get_winner()
+    print(f"LivePoll.vote_many in batches of {batch_size}: {time.perf_counter() - start_time:.4f}s")
+    assert (poll.get_votes(), poll.get_winner()) == expected
+
+    poll = ShardedPoll('Which option?', list(options))
+
+    def vote(share):
+        for option_index in share:
+            poll.vote(option_index)
+
+    start_time = time.perf_counter()
+    threads = [threading.Thread(target=vote, args=(ballot_list[i::num_threads],)) for i in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(f"ShardedPoll.vote from {num_threads} threads: {time.perf_counter() - start_time:.4f}s")
+    assert (poll.get_votes(), poll.get_winner()) == expected
+
+
+def compare_point_array(num_points=1_000_000, num_pairwise=1_000, num_queries=10):
+    """Compare loops over Points with PointArray and its GridIndex."""
+    rng = np.random.default_rng(0)
+    points = PointArray(rng.random((num_points, 2)) * 1000)
+    scalar_points = points.to_points()
+    origin = Point(500, 500)
+
+    start_time = time.perf_counter()
+    expected = [point.distance(origin) for point in scalar_points]
+    print(f"Point.distance loop: {time.perf_counter() - start_time:.4f}s")
+    start_time = time.perf_counter()
+    assert np.allclose(points.distance(origin), expected, rtol=1e-15)
+    print(f"PointArray.distance: {time.perf_counter() - start_time:.4f}s")
+
+    start_time = time.perf_counter()
+    [point + origin for point in scalar_points]
+    print(f"Point.__add__ loop: {time.perf_counter() - start_time:.4f}s")
+    start_time = time.perf_counter()
+    points + origin
+    print(f"PointArray.__add__: {time.perf_counter() - start_time:.4f}s")
+
+    few = scalar_points[:num_pairwise]
+    start_time = time.perf_counter()
+    expected = [[p.distance(q) for q in few] for p in few]
+    print(f"pairwise Point.distance loop: {time.perf_counter() - start_time:.4f}s")
+    start_time = time.perf_counter()
+    assert np.allclose(points[:num_pairwise].pairwise_distances(), expected, rtol=1e-15)
+    print(f"PointArray.pairwise_distances: {time.perf_counter() - start_time:.4f}s")
+
+    queries = PointArray(rng.random((num_queries, 2)) * 1000).to_points()
+    start_time = time.perf_counter()
+    expected = [min(range(num_points), key=lambda i: scalar_points[i].distance(query)) for query in queries]
+    print(f"nearest neighbour, Point loop: {time.perf_counter() - start_time:.4f}s")
+    start_time = time.perf_counter()
+    index = points.index()
+    print(f"GridIndex build: {time.perf_counter() - start_time:.4f}s")
+    start_time = time.perf_counter()
+    assert [index.nearest(query)[0][0] for query in queries] == expected
+    print(f"nearest neighbour, GridIndex: {time.perf_counter() - start_time:.4f}s")
 
 
 import random
@@ -327,6 +1853,194 @@ class Player2:
         self.hp = 100
 
 
+def _combat_statistics(defeat_rounds, num_fights, rounds, total_exp, num_players):
+    # defeat_rounds[r] is the number of enemies defeated in round r.
+    num_defeated = int(defeat_rounds.sum())
+    cumulative = np.cumsum(defeat_rounds)
+
+    def percentile(fraction):
+        return int(np.searchsorted(cumulative, math.ceil(fraction * num_defeated))) if num_defeated else None
+
+    return {
+        'fights': num_fights,
+        'rounds': rounds,
+        'defeated': num_defeated,
+        'defeat_rate': num_defeated / num_fights if num_fights else 0.0,
+        'mean_rounds_to_defeat': float(np.arange(len(defeat_rounds)) @ defeat_rounds) / num_defeated
+        if num_defeated else None,
+        'p50_rounds_to_defeat': percentile(0.5),
+        'p95_rounds_to_defeat': percentile(0.95),
+        'mean_exp': total_exp / num_players if num_players else 0.0,
+    }
+
+
+class CombatSimulation:
+    """Many Player-versus-Enemy fights at once, with the fighters as rows of NumPy arrays.
+
+    Each round, the player of every matchup attacks its enemy once, with damage
+    randint(5, 20) * level as in Player.attack, drawn for all matchups in one batch. An
+    enemy's hp stops at 0 as in Enemy.take_damage, and as in Player2.attack a defeated
+    enemy takes no more hits and the player gains exp equal to the damage of each hit.
+    When several players fight one enemy, all of them hit it in the round it falls,
+    since in Player2 each player drops the enemy from its own nemeses.
+
+    :param seed: Optional, the seed of the damage draws.
+    """
+
+    def __init__(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+        self.player_index = {}
+        self.enemy_index = {}
+        self.player_level = np.zeros(0, dtype=np.int64)
+        self.player_exp = np.zeros(0, dtype=np.int64)
+        self.enemy_hp = np.zeros(0, dtype=np.int64)
+        self.enemy_level = np.zeros(0, dtype=np.int64)
+        # The round each enemy was defeated in, or -1.
+        self.defeated_in_round = np.zeros(0, dtype=np.int64)
+        self.matchup_player = np.zeros(0, dtype=np.intp)
+        self.matchup_enemy = np.zeros(0, dtype=np.intp)
+        self.rounds = 0
+
+    @classmethod
+    def from_players(cls, players, seed=None):
+        """A simulation of each Player fighting each of its nemeses, which are Enemy objects."""
+        simulation = cls(seed)
+        for player in players:
+            simulation.add_players([player.name], [player.level])
+            for enemy in player.nemeses:
+                if enemy.name not in simulation.enemy_index:
+                    simulation.add_enemies([enemy.name], [enemy.hp], [enemy.level])
+                simulation.add_matchups([player.name], [enemy.name])
+        return simulation
+
+    def add_players(self, names, levels):
+        """Add players by name; names can be None to add unnamed ones, reached by row only."""
+        levels = np.asarray(levels, dtype=np.int64)
+        rows = np.arange(len(self.player_level), len(self.player_level) + len(levels))
+        if names is not None:
+            self._add_names(self.player_index, names, rows)
+        self.player_level = np.concatenate([self.player_level, levels])
+        self.player_exp = np.concatenate([self.player_exp, np.zeros(len(levels), dtype=np.int64)])
+        return rows
+
+    def add_enemies(self, names, hps, levels):
+        """Add enemies by name; names can be None to add unnamed ones, reached by row only."""
+        hps, levels = np.asarray(hps, dtype=np.int64), np.asarray(levels, dtype=np.int64)
+        rows = np.arange(len(self.enemy_hp), len(self.enemy_hp) + len(hps))
+        if names is not None:
+            self._add_names(self.enemy_index, names, rows)
+        self.enemy_hp = np.concatenate([self.enemy_hp, np.maximum(hps, 0)])
+        self.enemy_level = np.concatenate([self.enemy_level, levels])
+        self.defeated_in_round = np.concatenate([self.defeated_in_round, np.where(hps <= 0, 0, -1)])
+        return rows
+
+    @staticmethod
+    def _add_names(index, names, rows):
+        for name, row in zip(names, rows.tolist()):
+            if name in index:
+                raise ValueError(f"{name} was already added")
+            index[name] = row
+
+    def add_matchups(self, players, enemies):
+        """Add matchups, each player given by name or row against the enemy at the same position."""
+        players = [self.player_index[player] if isinstance(player, str) else player for player in players]
+        enemies = [self.enemy_index[enemy] if isinstance(enemy, str) else enemy for enemy in enemies]
+        self.matchup_player = np.concatenate([self.matchup_player, np.asarray(players, dtype=np.intp)])
+        self.matchup_enemy = np.concatenate([self.matchup_enemy, np.asarray(enemies, dtype=np.intp)])
+
+    def add_fights(self, num_fights, player_level=1, enemy_hp=100, enemy_level=1):
+        """Add num_fights one-on-one fights between new unnamed players and enemies."""
+        players = self.add_players(None, np.full(num_fights, player_level))
+        enemies = self.add_enemies(None, np.full(num_fights, enemy_hp), np.full(num_fights, enemy_level))
+        self.add_matchups(players, enemies)
+
+    def run(self, rounds):
+        """Fight up to rounds more rounds, stopping early once every matched enemy is defeated."""
+        order = np.arange(len(self.matchup_enemy))
+        for _ in range(rounds):
+            fighting = self.enemy_hp[self.matchup_enemy[order]] > 0
+            order = order[fighting]
+            enemies = self.matchup_enemy[order]
+            if not len(order):
+                break
+            self.rounds += 1
+            players = self.matchup_player[order]
+            damage = self.rng.integers(5, 21, len(order)) * self.player_level[players]
+            self.player_exp += np.bincount(players, damage, len(self.player_exp)).astype(np.int64)
+            self.enemy_hp -= np.bincount(enemies, damage, len(self.enemy_hp)).astype(np.int64)
+            defeated = self.enemy_hp <= 0
+            self.enemy_hp[defeated] = 0
+            self.defeated_in_round[defeated & (self.defeated_in_round < 0)] = self.rounds
+        return self.statistics()
+
+    def statistics(self):
+        """Counts and percentiles of the rounds it took to defeat the enemies, and the players' mean exp."""
+        defeated = self.defeated_in_round[self.defeated_in_round >= 0]
+        return _combat_statistics(np.bincount(defeated, minlength=self.rounds + 1), len(self.enemy_hp),
+                                  self.rounds, int(self.player_exp.sum()), len(self.player_exp))
+
+
+def _simulate_fights_shard(num_fights, rounds, player_level, enemy_hp, enemy_level, seed):
+    simulation = CombatSimulation(seed)
+    simulation.add_fights(num_fights, player_level, enemy_hp, enemy_level)
+    simulation.run(rounds)
+    defeated = simulation.defeated_in_round[simulation.defeated_in_round >= 0]
+    return np.bincount(defeated, minlength=rounds + 1), simulation.rounds, int(simulation.player_exp.sum())
+
+
+def simulate_fights(num_fights, rounds, player_level=1, enemy_hp=100, enemy_level=1, seed=None, workers=None):
+    """Simulate num_fights one-on-one fights, optionally split across workers processes.
+
+    Each shard gets its own random stream spawned from seed, so the results for a seed
+    depend on the number of workers.
+
+    :return: The same statistics as CombatSimulation.statistics.
+    """
+    num_shards = workers or 1
+    sizes = [num_fights // num_shards + (shard < num_fights % num_shards) for shard in range(num_shards)]
+    seeds = np.random.SeedSequence(seed).spawn(num_shards)
+    args = (sizes, [rounds] * num_shards, [player_level] * num_shards, [enemy_hp] * num_shards,
+            [enemy_level] * num_shards, seeds)
+    if workers:
+        with ProcessPoolExecutor(workers) as executor:
+            shards = list(executor.map(_simulate_fights_shard, *args))
+    else:
+        shards = list(map(_simulate_fights_shard, *args))
+    defeat_rounds = sum(histogram for histogram, _, _ in shards)
+    rounds_run = max(shard_rounds for _, shard_rounds, _ in shards)
+    return _combat_statistics(defeat_rounds[:rounds_run + 1], num_fights, rounds_run,
+                              sum(exp for _, _, exp in shards), num_fights)
+
+
+def compare_combat(num_fights=20_000, rounds=50, enemy_hp=100, workers=4):
+    """Compare fights between Player2 objects with CombatSimulation and simulate_fights."""
+    start_time = time.perf_counter()
+    defeat_rounds = []
+    for i in range(num_fights):
+        player = Player2(f'player{i}')
+        player.nemeses = [{'name': 'enemy', 'hp': enemy_hp}]
+        for round_number in range(1, rounds + 1):
+            player.attack('enemy')
+            if not player.nemeses:
+                defeat_rounds.append(round_number)
+                break
+    print(f"Player2 objects: {time.perf_counter() - start_time:.4f}s, "
+          f"mean rounds to defeat {sum(defeat_rounds) / len(defeat_rounds):.3f}")
+
+    start_time = time.perf_counter()
+    simulation = CombatSimulation(seed=0)
+    simulation.add_fights(num_fights, enemy_hp=enemy_hp)
+    statistics = simulation.run(rounds)
+    print(f"CombatSimulation: {time.perf_counter() - start_time:.4f}s, "
+          f"mean rounds to defeat {statistics['mean_rounds_to_defeat']:.3f}")
+
+    for shard_workers in (None, workers):
+        start_time = time.perf_counter()
+        statistics = simulate_fights(50 * num_fights, rounds, enemy_hp=enemy_hp, seed=0, workers=shard_workers)
+        print(f"simulate_fights, {50 * num_fights} fights, workers={shard_workers}: "
+              f"{time.perf_counter() - start_time:.4f}s, mean rounds to defeat {statistics['mean_rounds_to_defeat']:.3f}")
+
+
 class Square:
     def __init__(self, size):
         self.size = size
@@ -366,8 +2080,81 @@ class CubeTower:
         else:
             return False
 
+    @classmethod
+    def build_tallest(cls, cubes):
+        """Build the tower with the most cubes that can be stacked in the order they come.
+
+        The cubes can be any iterable, like a generator reading an inventory, and are read
+        once. This is the longest decreasing subsequence by size, with the extra rule that
+        neighbours differ in colour, in O(n log n).
+
+        For each height L it keeps the largest top size of any tower of that height, and
+        the largest among tops of another colour. A cube of size s and colour c goes on
+        the highest tower with a top larger than s: one bisect finds the highest tower H
+        with a top larger than s, and if that top and the runner-up both have colour c,
+        the cube below that top is larger than s and not of colour c, so H - 1 works.
+
+        :return: A CubeTower with the cubes from bottom to top.
+        :rtype: CubeTower
+        """
+        kept = []
+        below = array('q')
+        # Per height: minus the largest top size (ascending, for bisect), its cube and
+        # colour, and the largest top size among other colours and its cube.
+        neg_top_sizes, top_cubes, top_colors, runner_up_sizes, runner_up_cubes = [], [], [], [], []
+        for i, cube in enumerate(cubes):
+            kept.append(cube)
+            size, color = cube.base.size, cube.color
+            height = bisect.bisect_left(neg_top_sizes, -size)
+            if not height:
+                parent = -1
+            elif top_colors[height - 1] != color:
+                parent = top_cubes[height - 1]
+            elif runner_up_sizes[height - 1] > size:
+                parent = runner_up_cubes[height - 1]
+            else:
+                parent = below[top_cubes[height - 1]]
+                height -= 1
+            below.append(parent)
+            if height == len(neg_top_sizes):
+                neg_top_sizes.append(-size)
+                top_cubes.append(i)
+                top_colors.append(color)
+                runner_up_sizes.append(-math.inf)
+                runner_up_cubes.append(-1)
+            elif top_colors[height] == color:
+                if size > -neg_top_sizes[height]:
+                    neg_top_sizes[height], top_cubes[height] = -size, i
+            elif size > -neg_top_sizes[height]:
+                runner_up_sizes[height], runner_up_cubes[height] = -neg_top_sizes[height], top_cubes[height]
+                neg_top_sizes[height], top_cubes[height], top_colors[height] = -size, i, color
+            elif size > runner_up_sizes[height]:
+                runner_up_sizes[height], runner_up_cubes[height] = size, i
+
+        tower = cls()
+        i = top_cubes[-1] if top_cubes else -1
+        while i >= 0:
+            tower.cubes.append(kept[i])
+            i = below[i]
+        tower.cubes.reverse()
+        return tower
+
     def __str__(self):
-        res = ""
-        for i, cube in enumerate(self.cubes):
-            res += f"{i+1}-Cube: base-{cube.base.size}x{cube.base.size} color:{cube.color}\n"
-        return res
+        return "".join(f"{i+1}-Cube: base-{cube.base.size}x{cube.base.size} color:{cube.color}\n"
+                       for i, cube in enumerate(self.cubes))
+
+
+def compare_cube_tower(num_cubes=1_000_000, num_colors=3, max_size=1_000_000):
+    """Compare stacking a stream of cubes greedily with add_cube and optimally with build_tallest."""
+    rng = random.Random(0)
+    cubes = [Cube(rng.randint(1, max_size), rng.randrange(num_colors)) for _ in range(num_cubes)]
+
+    start_time = time.perf_counter()
+    greedy = CubeTower()
+    for cube in cubes:
+        greedy.add_cube(cube)
+    print(f"add_cube: {time.perf_counter() - start_time:.4f}s, {len(greedy.cubes)} cubes")
+
+    start_time = time.perf_counter()
+    tallest = CubeTower.build_tallest(iter(cubes))
+    print(f"build_tallest: {time.perf_counter() - start_time:.4f}s, {len(tallest.cubes)} cubes")